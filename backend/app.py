@@ -1,7 +1,21 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, request, jsonify, send_from_directory, Response, stream_with_context
 from flask_cors import CORS
 import openai
+import httpx
 import os
+import re
+import asyncio
+import threading
+import time
+import random
+import hashlib
+import tempfile
+import unicodedata
+import html
+from email.utils import parseaddr, parsedate_to_datetime
+from collections import OrderedDict, deque
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
 from dotenv import load_dotenv 
 import json
 from google.oauth2.credentials import Credentials
@@ -9,9 +23,24 @@ from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.cloud import texttospeech
-import uuid  # Add this to fix the NameError
+from google.api_core import exceptions as google_exceptions
 from datetime import datetime, timezone
 
+try:
+    import fcntl  # Used to coordinate cache eviction between worker processes
+except ImportError:  # Not available on Windows
+    fcntl = None
+
+try:
+    import tiktoken  # Exact token counts for the conversation window
+except ImportError:
+    tiktoken = None
+
+try:
+    import numpy as np  # Vector index for the semantic response cache
+except ImportError:
+    np = None
+
 
 load_dotenv()
 # Load API Key from environment variable
@@ -34,9 +63,259 @@ SCOPES = [
 # gmail_service = build("gmail", "v1", credentials=credentials)
 # calendar_service = build("calendar", "v3", credentials=credentials)
 AUDIO_DIR = "audio_responses"
-os.makedirs(AUDIO_DIR, exist_ok=True)  # Ensure directory exists
+
+# "disk" writes clips to AUDIO_DIR; "memory" keeps them in process memory, which
+# saves two disk I/Os per turn and works on read-only or ephemeral filesystems.
+AUDIO_STORE = os.getenv("AUDIO_STORE", "disk")
+AUDIO_MEMORY_MAX_BYTES = int(os.getenv("AUDIO_MEMORY_MAX_BYTES", str(64 * 1024 * 1024)))
+AUDIO_MEMORY_TTL = int(os.getenv("AUDIO_MEMORY_TTL", "3600"))  # seconds a clip stays servable
+
+if AUDIO_STORE == "disk":
+    os.makedirs(AUDIO_DIR, exist_ok=True)  # Ensure directory exists
+
+# Voice settings (also part of the TTS cache key)
+TTS_LANGUAGE_CODE = "en-US"
+TTS_VOICE_NAME = "en-US-Wavenet-D"  # Male voice
+TTS_TIMEOUT = float(os.getenv("TTS_TIMEOUT", "10"))  # seconds per synthesize_speech call
+TTS_WARM_UP = os.getenv("TTS_WARM_UP", "1") == "1"
+
+# Built once and reused for every synthesis request
+TTS_VOICE = texttospeech.VoiceSelectionParams(
+    language_code=TTS_LANGUAGE_CODE,
+    name=TTS_VOICE_NAME,
+    ssml_gender=texttospeech.SsmlVoiceGender.MALE
+)
+
+# Audio formats clients can negotiate with the "audio_format" request field or
+# the Accept header. "cache_tag" goes into the TTS cache key; only MP3 can be
+# split into sentence chunks and stitched back together.
+AUDIO_FORMATS = {
+    "mp3": {"encoding": "MP3", "sample_rate": None, "extension": "mp3", "mimetype": "audio/mpeg",
+            "cache_tag": "MP3", "stitchable": True},
+    "mp3-low": {"encoding": "MP3", "sample_rate": 16000, "extension": "mp3", "mimetype": "audio/mpeg",
+                "cache_tag": "MP3@16000", "stitchable": True},
+    "opus": {"encoding": "OGG_OPUS", "sample_rate": None, "extension": "ogg", "mimetype": "audio/ogg",
+             "cache_tag": "OGG_OPUS", "stitchable": False},
+}
+AUDIO_MIMETYPES = {fmt["extension"]: fmt["mimetype"] for fmt in AUDIO_FORMATS.values()}
+DEFAULT_AUDIO_FORMAT = "mp3"
+
+TTS_AUDIO_CONFIGS = {
+    name: texttospeech.AudioConfig(
+        audio_encoding=texttospeech.AudioEncoding[fmt["encoding"]],
+        sample_rate_hertz=fmt["sample_rate"] or 0,  # 0 = the voice's natural rate
+    )
+    for name, fmt in AUDIO_FORMATS.items()
+}
+
+# TTS engine: "google" (Cloud Text-to-Speech) or "local", an offline engine that
+# needs no network or credentials, for load tests and CI.
+TTS_BACKEND = os.getenv("TTS_BACKEND", "google")
+LOCAL_TTS_BASE_LATENCY = float(os.getenv("LOCAL_TTS_BASE_LATENCY", "0.15"))  # seconds per request
+LOCAL_TTS_CHAR_LATENCY = float(os.getenv("LOCAL_TTS_CHAR_LATENCY", "0.002"))  # extra seconds per character
+LOCAL_TTS_CHARS_PER_SECOND = float(os.getenv("LOCAL_TTS_CHARS_PER_SECOND", "15"))  # speaking rate of the output
+
+# One silent MPEG-1 Layer III frame (32 kbps, 44.1 kHz, mono): header followed by
+# zeroed side info and main data. 1152 samples, i.e. ~26 ms of audio.
+SILENT_MP3_FRAME = b"\xff\xfb\x10\xc0" + bytes(100)
+SILENT_MP3_FRAME_SECONDS = 1152 / 44100
+
+tts_health = {"healthy": None, "last_error": None, "last_success": None, "client_resets": 0}
+
+# Synthesized clips are stored under a hash of the text and voice settings, so
+# repeated answers are served from disk instead of calling Google TTS again.
+# Clips live in two-character hash-prefix subdirectories (audio_responses/3a/3a2c...mp3)
+# so no single directory grows to millions of entries.
+TTS_CACHE_MAX_BYTES = int(os.getenv("TTS_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+TTS_CACHE_LOCK_FILE = os.path.join(AUDIO_DIR, ".evict.lock")
+AUDIO_SHARD = re.compile(r"[0-9a-f]{2}")
+AUDIO_CLIP_ID = re.compile(r"[0-9a-f]{64}\.[a-z0-9]+")
+AUDIO_CACHE_MAX_AGE = 365 * 24 * 3600  # clip ids never change content, so browsers may keep them for a year
+
+# Background janitor that enforces the retention policies on AUDIO_DIR
+AUDIO_MAX_AGE = int(os.getenv("AUDIO_MAX_AGE", str(7 * 24 * 3600)))  # seconds since last use, 0 = no limit
+AUDIO_JANITOR_INTERVAL = int(os.getenv("AUDIO_JANITOR_INTERVAL", "600"))  # seconds between sweeps, 0 = disabled
+AUDIO_TMP_MAX_AGE = 3600  # leftovers from interrupted writes
+audio_janitor_metrics = {
+    "runs": 0,
+    "files_reclaimed": 0,
+    "bytes_reclaimed": 0,
+    "files": 0,
+    "bytes": 0,
+    "last_run": None,
+    "last_duration_ms": None,
+}
+
+# Long replies are split into sentence chunks that are synthesized concurrently
+# and stitched back together in order.
+TTS_PARALLEL = os.getenv("TTS_PARALLEL", "1") == "1"
+TTS_PARALLEL_MIN_CHARS = int(os.getenv("TTS_PARALLEL_MIN_CHARS", "400"))  # shorter replies use one call
+TTS_CHUNK_CHARS = int(os.getenv("TTS_CHUNK_CHARS", "250"))
+TTS_MAX_WORKERS = int(os.getenv("TTS_MAX_WORKERS", "4"))
+tts_executor = ThreadPoolExecutor(max_workers=TTS_MAX_WORKERS, thread_name_prefix="tts")
+
+# Fragment cache: replies are normalized and split into sentence/clause
+# fragments whose audio is cached on its own, so templated answers ("Email 1:",
+# "You have 3 events today.") are composed from cached frames and only the
+# missing fragments are synthesized.
+TTS_FRAGMENT_CACHE = os.getenv("TTS_FRAGMENT_CACHE", "0") == "1"
+FRAGMENT_BOUNDARY = re.compile(r"(?<=[.!?:;])\s+|\n+")
+tts_fragment_metrics = {"hits": 0, "misses": 0}
+tts_fragment_metrics_lock = threading.Lock()
+
+# Streamed audio: sentences are synthesized one by one into a buffer that the
+# /audio/stream/<id> endpoint sends while later sentences are still in flight.
+AUDIO_STREAM_TTL = int(os.getenv("AUDIO_STREAM_TTL", "300"))  # seconds a stream stays fetchable
+AUDIO_STREAM_CHUNK_TIMEOUT = int(os.getenv("AUDIO_STREAM_CHUNK_TIMEOUT", "30"))
+SENTENCE_BOUNDARY = re.compile(r"(?<=[.!?])\s+|\n+")
+# Stream and ticket ids are the reply's clip id, so once the clip is stored any
+# worker sharing the disk store can serve it; in-flight audio lives only in the
+# worker that started it (see the README on multiple workers).
+audio_streams = {}  # stream id -> (created_at, mimetype, AudioStreamBuffer)
+audio_streams_lock = threading.Lock()
+
+# Audio tickets: /api/chat returns the text right away and the clip is
+# synthesized in the background ("deferred") or on the first GET ("lazy").
+AUDIO_TICKET_TTL = int(os.getenv("AUDIO_TICKET_TTL", "600"))  # seconds a ticket stays redeemable
+AUDIO_TICKET_TIMEOUT = int(os.getenv("AUDIO_TICKET_TIMEOUT", "60"))  # seconds a GET waits for synthesis
+AUDIO_TICKET_WORKERS = int(os.getenv("AUDIO_TICKET_WORKERS", "4"))
+audio_ticket_executor = ThreadPoolExecutor(max_workers=AUDIO_TICKET_WORKERS, thread_name_prefix="audio-ticket")
+audio_tickets = {}  # ticket id -> (created_at, text, audio format, future resolving to a clip id)
+audio_tickets_lock = threading.Lock()
+
+# Email and calendar results are turned into speech-ready text by a local
+# template formatter; set VOICE_FORMATTER=llm to use the GPT-4o rewrite instead.
+VOICE_FORMATTER = os.getenv("VOICE_FORMATTER", "local")
+NUMBER_WORDS = ["no", "one", "two", "three", "four", "five", "six", "seven", "eight", "nine", "ten"]
+ORDINAL_WORDS = ["First", "Second", "Third", "Fourth", "Fifth"]
+MARKDOWN_LINK = re.compile(r"\[([^\]]*)\]\([^)]*\)")
+MARKDOWN_BLOCK = re.compile(r"^\s*(#{1,6}|[-*+>]|\d+\.)\s+", re.MULTILINE)
+# Paired emphasis only, at word boundaries, so snake_case names and 2*3 survive
+MARKDOWN_EMPHASIS = re.compile(r"(?<!\w)(\*{1,3}|_{1,3}|~~|`+)(?=\S)(.+?)(?<=\S)\1(?!\w)")
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}")
+EMAIL_SNIPPET_CHARS = int(os.getenv("EMAIL_SNIPPET_CHARS", "120"))
+
+# Phrase bank: fixed replies the backend speaks all the time. They are loaded
+# from a bundle (or synthesized once) at startup and kept in memory, so these
+# replies never wait on TTS. Rebuild the bundle after changing the voice with:
+#   flask --app app build-phrase-bank
+PHRASE_BANK_DIR = os.getenv("PHRASE_BANK_DIR", "phrase_bank")
+PHRASE_BANK_ON_START = os.getenv("PHRASE_BANK_ON_START", "1") == "1"
+PHRASE_BANK_PHRASES = [
+    # Keep in sync with the fixed strings returned by the handlers below
+    "You have no new emails.",
+    "Unknown email action.",
+    "You have no upcoming events.",
+    "Unknown calendar action.",
+    "Unknown function request.",
+    "Hello! How can I help you today?",
+    "Hi, I'm Clark. What can I do for you?",
+]
+phrase_bank_index = {}  # phrase text -> clip id
+phrase_bank_clips = {}  # clip id -> audio bytes
 
 conversation_history = []
+conversation_history_lock = threading.Lock()
+
+# Conversation window: history is trimmed to a token budget per model rather
+# than a message count. Override budgets with e.g. HISTORY_TOKEN_BUDGETS='{"gpt-4o": 16000}'.
+CHAT_MODEL = os.getenv("CHAT_MODEL", "gpt-4o")
+HISTORY_TOKEN_BUDGETS = {"gpt-4o": 8000, "gpt-4o-mini": 4000}
+HISTORY_TOKEN_BUDGETS.update(json.loads(os.getenv("HISTORY_TOKEN_BUDGETS", "{}")))
+DEFAULT_HISTORY_TOKEN_BUDGET = 4000
+MESSAGE_TOKEN_OVERHEAD = 4  # role and separators the API adds around each message
+# Model routing: each turn goes to the "small" or "large" route depending on
+# a cheap complexity estimate of the user message. Costs are USD per million
+# tokens. Override routes with e.g. MODEL_ROUTES='{"small": {"max_tokens": 200}}'.
+MODEL_ROUTING = os.getenv("MODEL_ROUTING", "1") == "1"
+MODEL_ROUTES = {
+    "small": {"model": "gpt-4o-mini", "max_tokens": 300, "input_cost": 0.15, "output_cost": 0.60},
+    "large": {"model": CHAT_MODEL, "max_tokens": 2000, "input_cost": 2.50, "output_cost": 10.00},
+}
+for route_name, route_overrides in json.loads(os.getenv("MODEL_ROUTES", "{}")).items():
+    MODEL_ROUTES.setdefault(route_name, {}).update(route_overrides)
+ROUTE_SMALL_MAX_WORDS = int(os.getenv("ROUTE_SMALL_MAX_WORDS", "20"))
+# Tool use, reasoning, writing or code needs the large model
+ROUTE_LARGE_HINTS = re.compile(
+    r"\b(?:e ?mails?|mail|inbox|calendar|schedule|meetings?|events?|appointments?|send|"
+    r"explain|compare|code|debug|write|draft|analy[sz]e|summari[sz]e|recommend|steps?|"
+    r"how (?:do|does|can|could|should|would|to)|why (?:do|does|did|is|are|was|would|should)|plan (?:a|an|my|the))\b"
+)
+route_metrics = {
+    route_name: {"requests": 0, "latency": 0.0, "prompt_tokens": 0, "completion_tokens": 0, "cost": 0.0}
+    for route_name in MODEL_ROUTES
+}
+route_metrics_lock = threading.Lock()
+# The shared history window is sized for the route with the largest budget;
+# turns on a smaller route trim their own copy of it (see start_turn).
+HISTORY_WINDOW_MODEL = max(
+    (route["model"] for route in MODEL_ROUTES.values()),
+    key=lambda model: HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+)
+
+# Shared OpenAI client: one keep-alive connection pool for every call, tight
+# timeouts for interactive latency, and our own retries (the SDK's are
+# disabled) with jittered exponential backoff. Retries draw from a budget
+# refilled by OPENAI_RETRY_BUDGET per request, so an outage cannot multiply load.
+OPENAI_POOL_SIZE = int(os.getenv("OPENAI_POOL_SIZE", "20"))
+OPENAI_KEEPALIVE_CONNECTIONS = int(os.getenv("OPENAI_KEEPALIVE_CONNECTIONS", "10"))
+OPENAI_KEEPALIVE_EXPIRY = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "60"))
+OPENAI_CONNECT_TIMEOUT = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "3"))
+OPENAI_READ_TIMEOUT = float(os.getenv("OPENAI_READ_TIMEOUT", "30"))
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "2"))
+OPENAI_RETRY_BASE_DELAY = float(os.getenv("OPENAI_RETRY_BASE_DELAY", "0.2"))
+OPENAI_RETRY_MAX_DELAY = float(os.getenv("OPENAI_RETRY_MAX_DELAY", "2"))
+OPENAI_RETRY_BUDGET = float(os.getenv("OPENAI_RETRY_BUDGET", "0.1"))  # retries per request
+OPENAI_RETRY_RESERVE = 10  # retries available before any requests have refilled the budget
+# Hedged chat completions: if the first token has not arrived after the
+# HEDGE_PERCENTILE time-to-first-token of recent requests, an identical backup
+# request (optionally to HEDGE_FALLBACK_MODEL) is sent and the first to start
+# streaming wins. Backups spend from a budget of HEDGE_BUDGET per request.
+HEDGING = os.getenv("HEDGING", "0") == "1"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", "0.3"))
+HEDGE_DEFAULT_DELAY = float(os.getenv("HEDGE_DEFAULT_DELAY", "1.5"))  # until enough samples are in
+HEDGE_MIN_SAMPLES = 20
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.05"))  # backup requests per request
+HEDGE_FALLBACK_MODEL = os.getenv("HEDGE_FALLBACK_MODEL", "")
+hedge_latencies = deque(maxlen=int(os.getenv("HEDGE_LATENCY_WINDOW", "500")))  # seconds to first token
+hedge_metrics = {"requests": 0, "hedged": 0, "backup_wins": 0, "budget_denied": 0}
+hedge_lock = threading.Lock()
+openai_pool_metrics = {"requests": 0, "in_flight": 0, "peak_in_flight": 0, "retries": 0, "retries_denied": 0, "failures": 0}
+openai_pool_metrics_lock = threading.Lock()
+
+# Once over budget, history is trimmed down to this fraction of it, so the
+# prompt prefix stays the same (and provider-cached) for the next few turns.
+HISTORY_TRIM_RATIO = float(os.getenv("HISTORY_TRIM_RATIO", "0.75"))
+
+# Exact-match response cache: replies to turns that did not call any tools are
+# reused when the same message arrives again with the same recent context.
+RESPONSE_CACHE = os.getenv("RESPONSE_CACHE", "1") == "1"
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000"))
+RESPONSE_CACHE_CONTEXT_MESSAGES = int(os.getenv("RESPONSE_CACHE_CONTEXT_MESSAGES", "2"))  # earlier turns in the key
+
+# Semantic response cache: when there is no exact match, the user message is
+# embedded and compared against earlier messages with the same context; a
+# close enough paraphrase reuses that reply. Needs numpy.
+SEMANTIC_CACHE = os.getenv("SEMANTIC_CACHE", "0") == "1"
+SEMANTIC_CACHE_EMBEDDER = os.getenv("SEMANTIC_CACHE_EMBEDDER", "local")  # "local" or "openai"
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0.92"))  # cosine similarity
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", "100000"))
+SEMANTIC_CACHE_COMPACT_INTERVAL = int(os.getenv("SEMANTIC_CACHE_COMPACT_INTERVAL", "300"))  # seconds, 0 disables
+LOCAL_EMBEDDING_DIMENSIONS = 256
+OPENAI_EMBEDDING_MODEL = os.getenv("OPENAI_EMBEDDING_MODEL", "text-embedding-3-small")
+OPENAI_EMBEDDING_DIMENSIONS = int(os.getenv("OPENAI_EMBEDDING_DIMENSIONS", "256"))
+
+# Rolling memory: turns evicted from the window are folded into a compact
+# running summary by a background worker, off the request path, and sent to
+# the model as a system message so older context is not lost.
+CONVERSATION_MEMORY = os.getenv("CONVERSATION_MEMORY", "1") == "1"
+MEMORY_MODEL = os.getenv("MEMORY_MODEL", "gpt-4o-mini")
+MEMORY_MAX_WORDS = int(os.getenv("MEMORY_MAX_WORDS", "200"))
+conversation_memory = {"summary": "", "pending": [], "updates": 0}
+conversation_memory_lock = threading.Lock()
+memory_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="memory")  # one update at a time
 
 KNOWLEDGE_BASE = """
 You are a personalized AI assistant named Clark.
@@ -55,64 +334,996 @@ When responding to questions, keep context in mind based on past conversations.
 def index():
     return "AI Assistant Backend is running!"
 
+# Tool calls run in parallel; one lock keeps them from refreshing the token,
+# rewriting token.json or starting the OAuth flow at the same time.
+credentials_lock = threading.Lock()
+
 def get_credentials():
-    creds = None
+    with credentials_lock:
+        creds = None
+
+        if os.path.exists(TOKEN_FILE):
+            creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+
+        # If no valid creds, either refresh or run new OAuth flow
+        if not creds or not creds.valid:
+            if creds and creds.expired and creds.refresh_token:
+                creds.refresh(Request())
+            else:
+                flow = InstalledAppFlow.from_client_secrets_file(
+                    CLIENT_SECRET_FILE,
+                    SCOPES
+                )
+                # Use extra arguments to ensure refresh token is provided
+                creds = flow.run_local_server(
+                    port=5000,
+                    redirect_uri_trailing_slash=False,
+                    access_type='offline',
+                    prompt='consent'
+                )
+
+            # Save credentials to token.json
+            with open(TOKEN_FILE, 'w') as token:
+                token.write(creds.to_json())
+
+        return creds
+
+openai_client = None
+openai_client_lock = threading.Lock()
+
+def get_openai_client():
+    """
+    Returns the shared OpenAI client, creating it on first use.
+    """
+    global openai_client
+    if openai_client is None:
+        with openai_client_lock:
+            if openai_client is None:
+                timeout = httpx.Timeout(OPENAI_READ_TIMEOUT, connect=OPENAI_CONNECT_TIMEOUT)
+                openai_client = openai.OpenAI(
+                    api_key=os.getenv("OPENAI_API_KEY"),
+                    max_retries=0,  # Retried in openai_request instead
+                    timeout=timeout,
+                    http_client=httpx.Client(
+                        timeout=timeout,
+                        limits=httpx.Limits(
+                            max_connections=OPENAI_POOL_SIZE,
+                            max_keepalive_connections=OPENAI_KEEPALIVE_CONNECTIONS,
+                            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY,
+                        ),
+                    ),
+                )
+    return openai_client
+
+class RetryBudget:
+    """
+    Token bucket for retries: every request deposits `ratio` tokens and every
+    retry spends one, so retries stay a bounded fraction of traffic.
+    """
+
+    def __init__(self, ratio, reserve):
+        self.ratio = ratio
+        self.reserve = reserve
+        self._tokens = float(reserve)
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.reserve, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens < 1:
+                return False
+            self._tokens -= 1
+            return True
+
+openai_retry_budget = RetryBudget(OPENAI_RETRY_BUDGET, OPENAI_RETRY_RESERVE)
+
+def is_retryable(error):
+    return isinstance(error, (openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError))
+
+def track_openai_request(delta):
+    with openai_pool_metrics_lock:
+        openai_pool_metrics["in_flight"] += delta
+        if delta > 0:
+            openai_pool_metrics["requests"] += 1
+            openai_pool_metrics["peak_in_flight"] = max(openai_pool_metrics["peak_in_flight"], openai_pool_metrics["in_flight"])
+
+def release_when_done(stream):
+    """
+    Yields a streamed response, counting it as in flight (it holds a pooled
+    connection) until it is exhausted or closed.
+    """
+    try:
+        yield from stream
+    finally:
+        close = getattr(stream, "close", None)
+        if close is not None:
+            close()
+        track_openai_request(-1)
+
+def openai_retry_delay(error, attempt):
+    """
+    Full-jitter exponential backoff before retrying a failed OpenAI call, or
+    None when the error is final: not retryable, out of attempts, or over the
+    retry budget. Shared by the Flask and ASGI request loops.
+    """
+    if not is_retryable(error) or attempt >= OPENAI_MAX_RETRIES:
+        return None
+    if not openai_retry_budget.withdraw():
+        with openai_pool_metrics_lock:
+            openai_pool_metrics["retries_denied"] += 1
+        return None
+    with openai_pool_metrics_lock:
+        openai_pool_metrics["retries"] += 1
+    delay = random.uniform(0, min(OPENAI_RETRY_MAX_DELAY, OPENAI_RETRY_BASE_DELAY * 2 ** attempt))
+    print(f"OpenAI request failed ({type(error).__name__}), retrying in {delay:.2f}s")
+    return delay
+
+def record_openai_failure():
+    with openai_pool_metrics_lock:
+        openai_pool_metrics["failures"] += 1
+    track_openai_request(-1)
+
+def openai_request(call, stream=False):
+    """
+    Runs call(client) on the shared client, retrying connection errors, rate
+    limits and 5xx responses with full-jitter exponential backoff while the
+    retry budget allows. Streamed responses are retried only until they start.
+    """
+    client = get_openai_client()
+    openai_retry_budget.deposit()
+    track_openai_request(1)
+    attempt = 0
+    try:
+        while True:
+            try:
+                response = call(client)
+                break
+            except Exception as e:
+                delay = openai_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+    except Exception:
+        record_openai_failure()
+        raise
+
+    if stream:
+        return release_when_done(response)
+    track_openai_request(-1)
+    return response
+
+def create_chat_completion(**kwargs):
+    """
+    chat.completions.create through the shared, pooled client.
+    """
+    return openai_request(lambda client: client.chat.completions.create(**kwargs), stream=kwargs.get("stream", False))
+
+hedge_budget = RetryBudget(HEDGE_BUDGET, 2)
+hedge_executor = ThreadPoolExecutor(max_workers=OPENAI_POOL_SIZE, thread_name_prefix="hedge")
 
-    if os.path.exists(TOKEN_FILE):
-        creds = Credentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+def hedge_delay():
+    """
+    Seconds to wait for the first token before sending a backup request.
+    """
+    with hedge_lock:
+        samples = sorted(hedge_latencies)
+    if len(samples) < HEDGE_MIN_SAMPLES:
+        return HEDGE_DEFAULT_DELAY
+    return max(HEDGE_MIN_DELAY, samples[min(len(samples) - 1, int(len(samples) * HEDGE_PERCENTILE / 100))])
+
+def start_stream(kwargs, cancelled, record_latency):
+    """
+    Opens a streamed completion and waits for its first chunk. Returns
+    (stream, first_chunk), or None if the request lost the race meanwhile.
+    """
+    started = time.monotonic()
+    stream = create_chat_completion(**kwargs)
+    try:
+        chunk = next(stream, None)
+    except Exception:
+        stream.close()
+        raise
+    if record_latency:
+        with hedge_lock:
+            hedge_latencies.append(time.monotonic() - started)
+    if cancelled.is_set():
+        stream.close()
+        return None
+    return stream, chunk
+
+def close_started_stream(future):
+    if not future.cancelled() and future.exception() is None and future.result() is not None:
+        future.result()[0].close()
+
+def relay_stream(stream, first_chunk):
+    try:
+        if first_chunk is not None:
+            yield first_chunk
+        yield from stream
+    finally:
+        stream.close()
+
+def hedged_stream(kwargs):
+    """
+    Streamed completion with a backup request sent if the first token is late.
+    The first request to start streaming wins; the other one is closed as soon
+    as it starts (or right away, if it already has).
+    """
+    hedge_budget.deposit()
+    with hedge_lock:
+        hedge_metrics["requests"] += 1
+    attempts = {}  # future -> event telling it that it lost
+    cancelled = threading.Event()
+    primary = hedge_executor.submit(start_stream, kwargs, cancelled, True)
+    attempts[primary] = cancelled
+    backup = None
 
-    # If no valid creds, either refresh or run new OAuth flow
-    if not creds or not creds.valid:
-        if creds and creds.expired and creds.refresh_token:
-            creds.refresh(Request())
+    done, _ = wait([primary], timeout=hedge_delay())
+    if not done:
+        if hedge_budget.withdraw():
+            backup_kwargs = dict(kwargs, model=HEDGE_FALLBACK_MODEL) if HEDGE_FALLBACK_MODEL else kwargs
+            cancelled = threading.Event()
+            backup = hedge_executor.submit(start_stream, backup_kwargs, cancelled, False)
+            attempts[backup] = cancelled
+            with hedge_lock:
+                hedge_metrics["hedged"] += 1
         else:
-            flow = InstalledAppFlow.from_client_secrets_file(
-                CLIENT_SECRET_FILE,
-                SCOPES
+            with hedge_lock:
+                hedge_metrics["budget_denied"] += 1
+
+    winner = None
+    error = None
+    pending = set(attempts)
+    while pending and winner is None:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                result = future.result()
+            except Exception as e:
+                error = error or e
+                continue
+            if winner is None:
+                winner = future, result
+            else:
+                result[0].close()
+
+    for future in pending:  # Losers still waiting for their first token
+        attempts[future].set()
+        future.add_done_callback(close_started_stream)
+
+    if winner is None:
+        raise error
+    if winner[0] is backup:
+        with hedge_lock:
+            hedge_metrics["backup_wins"] += 1
+    return relay_stream(*winner[1])
+
+def add_tool_call_deltas(tool_calls, deltas):
+    """
+    Assembles streamed tool-call deltas into tool_calls (index -> {"id", "name", "arguments"}).
+    """
+    for tool_call_delta in deltas or []:
+        tool_call = tool_calls.setdefault(tool_call_delta.index, {"id": "", "name": "", "arguments": ""})
+        tool_call["id"] += tool_call_delta.id or ""
+        if tool_call_delta.function:
+            tool_call["name"] += tool_call_delta.function.name or ""
+            tool_call["arguments"] += tool_call_delta.function.arguments or ""
+
+def chat_completion_stream(kwargs):
+    """
+    Streamed chat completion, hedged when HEDGING is on.
+    """
+    if HEDGING:
+        return hedged_stream(kwargs)
+    return create_chat_completion(**kwargs)
+
+def hedge_stats():
+    with hedge_lock:
+        stats = dict(hedge_metrics)
+    stats["delay"] = round(hedge_delay(), 3)
+    return stats
+
+def openai_pool_stats():
+    with openai_pool_metrics_lock:
+        stats = dict(openai_pool_metrics)
+    stats["pool_size"] = OPENAI_POOL_SIZE
+    stats["utilization"] = round(stats["in_flight"] / OPENAI_POOL_SIZE, 3)
+    return stats
+
+# Failures that mean the TTS channel (or its credentials) must be rebuilt
+TTS_CHANNEL_ERRORS = (google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded, google_exceptions.Unauthenticated)
+
+class GoogleTTSBackend:
+    """
+    Google Cloud Text-to-Speech. One long-lived client per process, so
+    credentials, the gRPC channel and the TLS handshake are paid once instead
+    of on every reply.
+    """
+
+    name = "google"
+    voice_name = TTS_VOICE_NAME
+    formats = ("mp3", "mp3-low", "opus")
+
+    def __init__(self):
+        self._client = None
+        self._client_lock = threading.Lock()
+        self._async_client = None  # Used from the ASGI server's event loop only
+
+    def get_client(self):
+        """
+        Returns the shared TTS client, creating it on first use.
+        """
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = texttospeech.TextToSpeechClient()
+        return self._client
+
+    def reset_client(self):
+        """
+        Drops the shared client after a channel failure so the next call reconnects.
+        """
+        with self._client_lock:
+            client, self._client = self._client, None
+            tts_health["client_resets"] += 1
+        if client is not None:
+            try:
+                client.transport.close()
+            except Exception as e:
+                print(f"Error closing TTS client: {e}")
+
+    def synthesize(self, text, audio_format=DEFAULT_AUDIO_FORMAT):
+        client = self.get_client()
+        synthesis_input = texttospeech.SynthesisInput(text=text)
+
+        try:
+            response = client.synthesize_speech(
+                input=synthesis_input, voice=TTS_VOICE, audio_config=TTS_AUDIO_CONFIGS[audio_format], timeout=TTS_TIMEOUT
             )
-            # Use extra arguments to ensure refresh token is provided
-            creds = flow.run_local_server(
-                port=5000,
-                redirect_uri_trailing_slash=False,
-                access_type='offline',
-                prompt='consent'
+        except TTS_CHANNEL_ERRORS as e:
+            # The channel (or its credentials) went bad: report it and reconnect next time
+            tts_health.update(healthy=False, last_error=f"{type(e).__name__}: {e}")
+            self.reset_client()
+            raise
+
+        tts_health.update(healthy=True, last_success=time.time())
+        return response.audio_content
+
+    def get_async_client(self):
+        """
+        Returns the shared async TTS client, creating it on first use.
+        """
+        if self._async_client is None:
+            self._async_client = texttospeech.TextToSpeechAsyncClient()
+        return self._async_client
+
+    async def reset_async_client(self):
+        client, self._async_client = self._async_client, None
+        tts_health["client_resets"] += 1
+        if client is not None:
+            try:
+                await client.transport.close()
+            except Exception as e:
+                print(f"Error closing TTS client: {e}")
+
+    async def synthesize_async(self, text, audio_format=DEFAULT_AUDIO_FORMAT):
+        try:
+            response = await self.get_async_client().synthesize_speech(
+                input=texttospeech.SynthesisInput(text=text), voice=TTS_VOICE,
+                audio_config=TTS_AUDIO_CONFIGS[audio_format], timeout=TTS_TIMEOUT
             )
+        except TTS_CHANNEL_ERRORS as e:
+            tts_health.update(healthy=False, last_error=f"{type(e).__name__}: {e}")
+            await self.reset_async_client()
+            raise
 
-        # Save credentials to token.json
-        with open(TOKEN_FILE, 'w') as token:
-            token.write(creds.to_json())
+        tts_health.update(healthy=True, last_success=time.time())
+        return response.audio_content
 
-    return creds
+class LocalTTSBackend:
+    """
+    Offline engine for benchmarking: sleeps for a configurable, length
+    dependent latency and returns deterministic silent MP3 as long as the
+    text would take to speak.
+    """
 
-def speak_response_google(text):
-    client = texttospeech.TextToSpeechClient()
-    
-    synthesis_input = texttospeech.SynthesisInput(text=text)
-    voice = texttospeech.VoiceSelectionParams(
-        language_code="en-US",
-        name="en-US-Wavenet-D",  # Male voice
-        ssml_gender=texttospeech.SsmlVoiceGender.MALE
-    )
-    audio_config = texttospeech.AudioConfig(
-        audio_encoding=texttospeech.AudioEncoding.MP3
-    )
+    name = "local"
+    voice_name = "local-silence"
+    formats = ("mp3", "mp3-low")
 
-    response = client.synthesize_speech(
-        input=synthesis_input, voice=voice, audio_config=audio_config
-    )
+    def __init__(self, base_latency=LOCAL_TTS_BASE_LATENCY, char_latency=LOCAL_TTS_CHAR_LATENCY,
+                 chars_per_second=LOCAL_TTS_CHARS_PER_SECOND):
+        self.base_latency = base_latency
+        self.char_latency = char_latency
+        self.chars_per_second = chars_per_second
+
+    def latency(self, text):
+        return self.base_latency + self.char_latency * len(text)
+
+    def silence(self, text):
+        frames = max(1, round(len(text) / self.chars_per_second / SILENT_MP3_FRAME_SECONDS))
+        tts_health.update(healthy=True, last_success=time.time())
+        return SILENT_MP3_FRAME * frames
+
+    def synthesize(self, text, audio_format=DEFAULT_AUDIO_FORMAT):
+        time.sleep(self.latency(text))
+        return self.silence(text)
+
+    async def synthesize_async(self, text, audio_format=DEFAULT_AUDIO_FORMAT):
+        await asyncio.sleep(self.latency(text))
+        return self.silence(text)
+
+TTS_BACKENDS = {"google": GoogleTTSBackend, "local": LocalTTSBackend}
+tts_backend = TTS_BACKENDS[TTS_BACKEND]()
+
+def synthesize_speech(text, audio_format=DEFAULT_AUDIO_FORMAT):
+    """
+    Synthesizes text with the configured TTS backend and returns the raw audio bytes.
+    """
+    return tts_backend.synthesize(text, audio_format)
+
+def negotiate_audio_format(requested=None, accept_mimetypes=None):
+    """
+    Picks the audio format for a reply: an explicit "audio_format" request
+    field wins, otherwise the best match for the Accept header (of the current
+    request, unless accept_mimetypes is given) among the formats the TTS
+    backend can produce.
+    """
+    if requested in tts_backend.formats:
+        return requested
+    if requested:
+        print(f"Unsupported audio format {requested!r}, negotiating instead")
+
+    offered = []
+    for name in tts_backend.formats:
+        if AUDIO_FORMATS[name]["mimetype"] not in offered:
+            offered.append(AUDIO_FORMATS[name]["mimetype"])
+    if accept_mimetypes is None:
+        accept_mimetypes = request.accept_mimetypes
+    mimetype = accept_mimetypes.best_match(offered, default=AUDIO_FORMATS[DEFAULT_AUDIO_FORMAT]["mimetype"])
+    for name in tts_backend.formats:
+        if AUDIO_FORMATS[name]["mimetype"] == mimetype:
+            return name
+    return DEFAULT_AUDIO_FORMAT
+
+def audio_clip_id(text, audio_format=DEFAULT_AUDIO_FORMAT):
+    fmt = AUDIO_FORMATS[audio_format]
+    return f"{tts_cache_key(text, encoding=fmt['cache_tag'])}.{fmt['extension']}"
+
+def audio_mimetype(filename):
+    return AUDIO_MIMETYPES.get(os.path.splitext(filename)[1].lstrip("."), "application/octet-stream")
+
+def warm_up_tts():
+    """
+    Creates the shared client and makes a throwaway call so the first real
+    reply does not pay for connection setup.
+    """
+    try:
+        synthesize_speech("Hello.")
+        print("✅ TTS client warmed up")
+    except Exception as e:
+        tts_health.update(healthy=False, last_error=f"{type(e).__name__}: {e}")
+        print(f"Error warming up TTS client: {e}")
 
-    # Generate a unique filename
-    filename = f"{uuid.uuid4()}.mp3"
-    file_path = os.path.join(AUDIO_DIR, filename)
+def tts_cache_key(text, voice_name=None, language_code=TTS_LANGUAGE_CODE, encoding=AUDIO_FORMATS[DEFAULT_AUDIO_FORMAT]["cache_tag"]):
+    """
+    Content address for a synthesized clip: identical text and voice settings
+    always map to the same file.
+    """
+    voice_name = voice_name or tts_backend.voice_name
+    payload = json.dumps([text, voice_name, language_code, encoding], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def write_audio_file(file_path, audio_content):
+    """
+    Writes audio atomically so other workers never see a half-written clip.
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(file_path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as out:
+            out.write(audio_content)
+        os.replace(tmp_path, file_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def audio_path(filename):
+    """
+    Location of a clip inside its hash-prefix shard of AUDIO_DIR.
+    """
+    return os.path.join(AUDIO_DIR, filename[:2], filename)
+
+def iter_audio_files():
+    """
+    Yields (path, stat) for every file in AUDIO_DIR, including its shards.
+    """
+    with os.scandir(AUDIO_DIR) as entries:
+        for entry in entries:
+            try:
+                if entry.is_dir():
+                    if not AUDIO_SHARD.fullmatch(entry.name):
+                        continue
+                    with os.scandir(entry.path) as shard_entries:
+                        for shard_entry in shard_entries:
+                            if shard_entry.is_file():
+                                yield shard_entry.path, shard_entry.stat()
+                elif entry.is_file() and not entry.name.startswith("."):
+                    yield entry.path, entry.stat()  # Clip from before sharding
+            except FileNotFoundError:
+                continue  # Removed while we were looking at it
+
+def remove_audio_file(path):
+    try:
+        os.remove(path)
+        return True
+    except FileNotFoundError:
+        return False
+
+def run_audio_janitor(max_age=AUDIO_MAX_AGE, max_bytes=TTS_CACHE_MAX_BYTES):
+    """
+    Deletes clips not used within max_age seconds, then the least recently used
+    clips until AUDIO_DIR fits in max_bytes. Only one process sweeps at a time;
+    the others skip and carry on.
+    """
+    with open(TTS_CACHE_LOCK_FILE, "a") as lock_file:
+        if fcntl is not None:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # Another worker is already sweeping
+
+        started = time.monotonic()
+        now = time.time()
+        clips = []
+        total_bytes = 0
+        files_reclaimed = 0
+        bytes_reclaimed = 0
+
+        for path, stat in iter_audio_files():
+            age = now - stat.st_mtime  # mtime is bumped on every cache hit
+            if path.endswith(".tmp"):
+                expired = age > AUDIO_TMP_MAX_AGE
+            else:
+                expired = max_age and age > max_age
+            if expired:
+                if remove_audio_file(path):
+                    files_reclaimed += 1
+                    bytes_reclaimed += stat.st_size
+                continue
+            clips.append((stat.st_mtime, stat.st_size, path))
+            total_bytes += stat.st_size
+
+        if total_bytes > max_bytes:
+            clips.sort()  # Oldest access time first
+            while clips and total_bytes > max_bytes:
+                _, size, path = clips.pop(0)
+                if remove_audio_file(path):
+                    files_reclaimed += 1
+                    bytes_reclaimed += size
+                total_bytes -= size
+
+        audio_janitor_metrics["runs"] += 1
+        audio_janitor_metrics["files_reclaimed"] += files_reclaimed
+        audio_janitor_metrics["bytes_reclaimed"] += bytes_reclaimed
+        audio_janitor_metrics["files"] = len(clips)
+        audio_janitor_metrics["bytes"] = total_bytes
+        audio_janitor_metrics["last_run"] = now
+        audio_janitor_metrics["last_duration_ms"] = round((time.monotonic() - started) * 1000, 1)
+
+        if files_reclaimed:
+            print(f"🧹 Audio janitor reclaimed {files_reclaimed} files ({bytes_reclaimed} bytes)")
+
+def audio_janitor_loop():
+    while True:
+        try:
+            run_audio_janitor()
+        except Exception as e:
+            print(f"Error in audio janitor: {e}")
+        time.sleep(AUDIO_JANITOR_INTERVAL)
+
+class MemoryAudioStore:
+    """
+    Keeps synthesized clips as immutable bytes, bounded by total size and
+    evicted by age (oldest first) or least recent use.
+    """
+
+    def __init__(self, max_bytes, ttl):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._clips = OrderedDict()  # clip id -> (expires_at, audio bytes)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def put(self, clip_id, audio_content):
+        audio_content = bytes(audio_content)
+        with self._lock:
+            if clip_id in self._clips:
+                self._bytes -= len(self._clips.pop(clip_id)[1])
+            self._clips[clip_id] = (time.monotonic() + self.ttl, audio_content)
+            self._bytes += len(audio_content)
+            self._evict()
+
+    def get(self, clip_id):
+        with self._lock:
+            entry = self._clips.get(clip_id)
+            if entry is None:
+                return None
+            expires_at, audio_content = entry
+            if expires_at < time.monotonic():
+                del self._clips[clip_id]
+                self._bytes -= len(audio_content)
+                return None
+            self._clips.move_to_end(clip_id)
+            return audio_content
 
-    # Save the file
-    with open(file_path, "wb") as out:
-        out.write(response.audio_content)
+    def __contains__(self, clip_id):
+        return self.get(clip_id) is not None
 
-    print(f"✅ Audio file generated: {file_path}")  # Debugging
+    def stats(self):
+        with self._lock:
+            return {"clips": len(self._clips), "bytes": self._bytes, "max_bytes": self.max_bytes}
+
+    def _evict(self):
+        now = time.monotonic()
+        for clip_id in [cid for cid, (expires_at, _) in self._clips.items() if expires_at < now]:
+            self._bytes -= len(self._clips.pop(clip_id)[1])
+        while self._clips and self._bytes > self.max_bytes:
+            _, (_, audio_content) = self._clips.popitem(last=False)
+            self._bytes -= len(audio_content)
+
+memory_audio_store = MemoryAudioStore(AUDIO_MEMORY_MAX_BYTES, AUDIO_MEMORY_TTL)
+
+def clip_is_cached(clip_id):
+    """
+    True if the clip is in the audio store; disk hits are marked as recently used.
+    """
+    if AUDIO_STORE == "memory":
+        return clip_id in memory_audio_store
+    try:
+        os.utime(audio_path(clip_id))  # Mark as recently used for LRU eviction
+        return True
+    except FileNotFoundError:
+        return False
+
+def read_cached_clip(clip_id):
+    """
+    Returns the clip's bytes from the audio store, or None on a miss.
+    """
+    if AUDIO_STORE == "memory":
+        return memory_audio_store.get(clip_id)
+    file_path = audio_path(clip_id)
+    try:
+        with open(file_path, "rb") as f:
+            audio_content = f.read()
+        os.utime(file_path)
+        return audio_content
+    except FileNotFoundError:
+        return None
+
+def store_clip(clip_id, audio_content):
+    if AUDIO_STORE == "memory":
+        memory_audio_store.put(clip_id, audio_content)
+        return
+    file_path = audio_path(clip_id)
+    os.makedirs(os.path.dirname(file_path), exist_ok=True)
+    write_audio_file(file_path, audio_content)
+
+def normalize_tts_text(text):
+    """
+    Canonical form of text for caching: Unicode NFKC with whitespace collapsed.
+    """
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+def split_fragments(text):
+    """
+    Splits normalized text into sentence and clause fragments ("Email 1:", "From Jane.").
+    """
+    return [fragment.strip() for fragment in FRAGMENT_BOUNDARY.split(text) if fragment.strip()]
+
+def count_fragment(outcome):
+    with tts_fragment_metrics_lock:
+        tts_fragment_metrics[outcome] += 1
+
+def fragment_stats():
+    with tts_fragment_metrics_lock:
+        return dict(tts_fragment_metrics)
+
+def synthesize_fragment(fragment, audio_format=DEFAULT_AUDIO_FORMAT):
+    """
+    Returns a fragment's audio from the cache, synthesizing and caching it on a miss.
+    """
+    clip_id = audio_clip_id(fragment, audio_format)
+    audio_content = read_cached_clip(clip_id)
+    if audio_content is not None:
+        count_fragment("hits")
+        return audio_content
+
+    count_fragment("misses")
+    audio_content = synthesize_speech(fragment, audio_format)
+    store_clip(clip_id, audio_content)
+    return audio_content
+
+def compose_from_fragments(text, audio_format=DEFAULT_AUDIO_FORMAT):
+    """
+    Builds a clip by concatenating cached fragment frames in order; missing
+    fragments are synthesized concurrently on the TTS pool.
+    """
+    fragments = split_fragments(text)
+    if len(fragments) <= 1:
+        return synthesize_fragment(text, audio_format)
+    parts = tts_executor.map(lambda fragment: synthesize_fragment(fragment, audio_format), fragments)
+    return stitch_mp3(list(parts))  # map keeps input order
+
+def synthesize_for_reply(text, audio_format=DEFAULT_AUDIO_FORMAT):
+    stitchable = AUDIO_FORMATS[audio_format]["stitchable"]
+    if TTS_FRAGMENT_CACHE and stitchable:
+        return compose_from_fragments(text, audio_format)
+    if TTS_PARALLEL and stitchable and len(text) >= TTS_PARALLEL_MIN_CHARS:
+        return synthesize_parallel(text, audio_format)
+    return synthesize_speech(text, audio_format)
+
+def speak_response_google(text, audio_format=DEFAULT_AUDIO_FORMAT):
+    text = normalize_tts_text(text)
+    if audio_format == DEFAULT_AUDIO_FORMAT and text in phrase_bank_index:
+        return phrase_bank_index[text]  # Pre-synthesized, no TTS call
+
+    filename = audio_clip_id(text, audio_format)
+    if clip_is_cached(filename):
+        print(f"✅ Audio cache hit: {filename}")  # Debugging
+        return filename
+
+    store_clip(filename, synthesize_for_reply(text, audio_format))
+    print(f"✅ Audio clip generated ({AUDIO_STORE}): {filename}")  # Debugging
 
     return filename  # Return the filename, NOT the full path
 
+def phrase_bank_voice():
+    return {"voice_name": tts_backend.voice_name, "language_code": TTS_LANGUAGE_CODE, "encoding": AUDIO_FORMATS[DEFAULT_AUDIO_FORMAT]["cache_tag"]}
+
+def build_phrase_bank(phrases=PHRASE_BANK_PHRASES):
+    """
+    Synthesizes every phrase on the TTS pool and returns {phrase: (clip id, audio bytes)}.
+    """
+    clips = list(tts_executor.map(synthesize_speech, phrases))
+    return {phrase: (audio_clip_id(phrase), audio) for phrase, audio in zip(phrases, clips)}
+
+def save_phrase_bank(bank, bundle_dir=PHRASE_BANK_DIR):
+    os.makedirs(bundle_dir, exist_ok=True)
+    for clip_id, audio_content in bank.values():
+        write_audio_file(os.path.join(bundle_dir, clip_id), audio_content)
+    manifest = {"voice": phrase_bank_voice(), "phrases": {phrase: clip_id for phrase, (clip_id, _) in bank.items()}}
+    write_audio_file(os.path.join(bundle_dir, "manifest.json"), json.dumps(manifest, indent=2).encode("utf-8"))
+
+def read_phrase_bank(bundle_dir=PHRASE_BANK_DIR):
+    """
+    Loads a persisted bundle, or returns None if it is missing, incomplete or
+    was built for a different voice.
+    """
+    try:
+        with open(os.path.join(bundle_dir, "manifest.json"), encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("voice") != phrase_bank_voice():
+            print("Phrase bank was built for a different voice, ignoring it")
+            return None
+        bank = {}
+        for phrase, clip_id in manifest["phrases"].items():
+            with open(os.path.join(bundle_dir, clip_id), "rb") as f:
+                bank[phrase] = (clip_id, f.read())
+        return bank
+    except (OSError, ValueError, KeyError) as e:
+        print(f"Phrase bank bundle not loaded: {e}")
+        return None
+
+def load_phrase_bank():
+    """
+    Fills the in-memory phrase bank from the bundle, synthesizing any phrase
+    the bundle does not cover.
+    """
+    bank = read_phrase_bank() or {}
+    missing = [phrase for phrase in PHRASE_BANK_PHRASES if phrase not in bank]
+    if missing:
+        try:
+            bank.update(build_phrase_bank(missing))
+        except Exception as e:
+            print(f"Error synthesizing phrase bank: {e}")
+
+    for phrase, (clip_id, audio_content) in bank.items():
+        phrase_bank_clips[clip_id] = audio_content
+        phrase_bank_index[phrase] = clip_id
+    print(f"✅ Phrase bank ready: {len(phrase_bank_index)} phrases")
+
+def split_sentences(text):
+    """
+    Splits text at sentence boundaries so each sentence can be synthesized on its own.
+    """
+    return [sentence.strip() for sentence in SENTENCE_BOUNDARY.split(text) if sentence.strip()]
+
+def chunk_sentences(text, max_chars=TTS_CHUNK_CHARS):
+    """
+    Groups sentences into chunks of up to max_chars so long replies become a
+    handful of similarly sized synthesis requests.
+    """
+    chunks = []
+    current = ""
+    for sentence in split_sentences(text):
+        if current and len(current) + 1 + len(sentence) > max_chars:
+            chunks.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}" if current else sentence
+    if current:
+        chunks.append(current)
+    return chunks
+
+def strip_id3(audio_content):
+    """
+    Removes a leading ID3v2 tag so MP3 frames from several clips can be joined.
+    """
+    if audio_content[:3] != b"ID3" or len(audio_content) < 10:
+        return audio_content
+    # Tag size is a 28-bit "syncsafe" integer (7 bits per byte)
+    size = 0
+    for byte in audio_content[6:10]:
+        size = (size << 7) | (byte & 0x7F)
+    footer = 10 if audio_content[5] & 0x10 else 0
+    return audio_content[10 + size + footer:]
+
+def stitch_mp3(parts):
+    """
+    Concatenates MP3 clips in order, keeping only the first clip's ID3 tag.
+    """
+    if not parts:
+        return b""
+    return parts[0] + b"".join(strip_id3(part) for part in parts[1:])
+
+def synthesize_parallel(text, audio_format=DEFAULT_AUDIO_FORMAT):
+    """
+    Synthesizes sentence chunks concurrently on the TTS pool, so wall-clock
+    time follows the slowest chunk rather than the total length.
+    """
+    chunks = chunk_sentences(text)
+    if len(chunks) <= 1:
+        return synthesize_speech(text, audio_format)
+    parts = tts_executor.map(lambda chunk: synthesize_speech(chunk, audio_format), chunks)
+    return stitch_mp3(list(parts))  # map keeps input order
+
+class AudioStreamBuffer:
+    """
+    MP3 chunks of one streamed reply. Chunks are kept, so every request for
+    the stream (e.g. a media element's probe or Range request followed by the
+    real fetch) replays it from the start while synthesis continues.
+    """
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self._condition = threading.Condition()
+
+    def append(self, chunk):
+        with self._condition:
+            self.chunks.append(chunk)
+            self._condition.notify_all()
+
+    def finish(self):
+        with self._condition:
+            self.done = True
+            self._condition.notify_all()
+
+    def read(self, timeout):
+        """
+        Yields every chunk from the start, waiting up to timeout seconds for
+        each new one until the stream is finished.
+        """
+        index = 0
+        while True:
+            with self._condition:
+                if not self._condition.wait_for(lambda: index < len(self.chunks) or self.done, timeout):
+                    raise TimeoutError("no audio chunk within timeout")
+                if index == len(self.chunks):
+                    return
+                chunk = self.chunks[index]
+            index += 1
+            yield chunk
+
+def start_audio_stream(text, audio_format=DEFAULT_AUDIO_FORMAT):
+    """
+    Starts synthesizing text sentence by sentence in the background and returns
+    the stream path to hand to the client. The first sentence is synthesized
+    right away, so playback can begin before the rest of the answer is ready.
+    """
+    spoken = normalize_tts_text(text)
+    stream_id = audio_clip_id(spoken, audio_format)
+    chunks = AudioStreamBuffer()
+
+    def synthesize_sentences():
+        try:
+            # Queue every sentence on the TTS pool up front; the first one starts
+            # immediately and the rest synthesize while earlier ones are playing.
+            if TTS_FRAGMENT_CACHE:
+                pieces, synthesize = split_fragments(spoken), synthesize_fragment
+            else:
+                pieces, synthesize = split_sentences(spoken), synthesize_speech
+            futures = [tts_executor.submit(synthesize, piece, audio_format) for piece in pieces]
+            for i, future in enumerate(futures):
+                audio_content = future.result()
+                chunks.append(audio_content if i == 0 else strip_id3(audio_content))
+            # Keep the whole clip, so the next identical reply is served from the cache
+            store_clip(stream_id, b"".join(chunks.chunks))
+        except Exception as e:
+            print(f"Error streaming audio: {e}")
+        finally:
+            chunks.finish()
+
+    now = time.monotonic()
+    with audio_streams_lock:
+        # Streams stay fetchable (and replayable) until their TTL runs out
+        for expired_id in [sid for sid, (created, _, _) in audio_streams.items() if now - created > AUDIO_STREAM_TTL]:
+            del audio_streams[expired_id]
+        entry = audio_streams.get(stream_id)
+        if entry is not None and not entry[2].done:
+            return f"stream/{stream_id}"  # The same reply is already streaming
+        audio_streams[stream_id] = (now, AUDIO_FORMATS[audio_format]["mimetype"], chunks)
+
+    threading.Thread(target=synthesize_sentences, daemon=True).start()
+    return f"stream/{stream_id}"
+
+def issue_audio_ticket(text, audio_format=DEFAULT_AUDIO_FORMAT, lazy=False):
+    """
+    Registers text for synthesis and returns the ticket path to hand to the
+    client. Deferred tickets start synthesizing now; lazy ones wait for the
+    first GET. Identical replies share a ticket.
+    """
+    ticket_id = audio_clip_id(normalize_tts_text(text), audio_format)
+
+    now = time.monotonic()
+    with audio_tickets_lock:
+        for expired_id in [tid for tid, (created, _, _, _) in audio_tickets.items() if now - created > AUDIO_TICKET_TTL]:
+            del audio_tickets[expired_id]
+        entry = audio_tickets.get(ticket_id)
+        future = entry[3] if entry is not None else None
+        if future is None or future.done() and future.exception() is not None:
+            future = Future()  # New, or the last attempt failed
+        audio_tickets[ticket_id] = (now, text, audio_format, future)
+
+    if not lazy:
+        audio_ticket_executor.submit(redeem_audio_ticket, text, audio_format, future)
+    return f"ticket/{ticket_id}"
+
+def redeem_audio_ticket(text, audio_format, future):
+    """
+    Synthesizes a ticket's clip unless another thread already claimed it.
+    """
+    with audio_tickets_lock:
+        if future.running() or future.done() or not future.set_running_or_notify_cancel():
+            return
+    try:
+        future.set_result(speak_response_google(text, audio_format))
+    except Exception as e:
+        future.set_exception(e)
+
+def render_audio(text, audio_mode="file", audio_format=DEFAULT_AUDIO_FORMAT):
+    """
+    Produces the audio reference returned to the client for the given mode:
+    "file", "stream", "deferred", "lazy" or "none" (text only).
+    """
+    if audio_mode == "none":
+        return None
+    if audio_format == DEFAULT_AUDIO_FORMAT and text in phrase_bank_index:
+        return phrase_bank_index[text]  # Already synthesized, nothing to defer
+    clip_id = audio_clip_id(normalize_tts_text(text), audio_format)
+    if clip_is_cached(clip_id):
+        return clip_id  # Already synthesized, for any mode
+    if audio_mode == "stream" and AUDIO_FORMATS[audio_format]["stitchable"]:
+        return start_audio_stream(text, audio_format)
+    if audio_mode in ("deferred", "lazy"):
+        return issue_audio_ticket(text, audio_format, lazy=audio_mode == "lazy")
+    return speak_response_google(text, audio_format)
+
 
 # Function mapping for Clark
 # def handle_email_action(action, email_subject=None, email_body=None):
@@ -142,6 +1353,7 @@ def handle_email_action(action, email_subject=None, email_body=None):
                 return "You have no new emails."
 
             cleaned_emails = []
+            emails = []
             for i, msg in enumerate(messages, start=1):
                 msg_data = service.users().messages().get(
                     userId="me", 
@@ -160,9 +1372,12 @@ def handle_email_action(action, email_subject=None, email_body=None):
 
                 email_summary = f"Email {i}: From {sender}, Subject: {subject}, Date: {date_str}. Summary: {snippet}"
                 cleaned_emails.append(email_summary)
+                emails.append({"sender": sender, "subject": subject, "date": date_str, "snippet": msg_data.get("snippet", "")})
 
-            raw_response = "\n".join(cleaned_emails)
-            return format_with_gpt4(raw_response)  # ✅ Clean with GPT-4
+            if VOICE_FORMATTER == "llm":
+                raw_response = "\n".join(cleaned_emails)
+                return format_with_gpt4(raw_response)  # ✅ Clean with GPT-4
+            return format_emails_for_voice(emails)
 
         except Exception as e:
             return f"Error fetching emails: {e}"
@@ -202,8 +1417,10 @@ def handle_calendar_action(action, event_details=None):
                 start = event["start"].get("dateTime", event["start"].get("date"))
                 event_list.append(f"{summary} on {start}")
 
-            raw_response = "\n".join(event_list)
-            return format_with_gpt4(raw_response)  # ✅ Clean with GPT-4
+            if VOICE_FORMATTER == "llm":
+                raw_response = "\n".join(event_list)
+                return format_with_gpt4(raw_response)  # ✅ Clean with GPT-4
+            return format_events_for_voice(events)
 
         except Exception as e:
             return f"Error fetching calendar events: {e}"
@@ -221,14 +1438,16 @@ def format_with_gpt4(raw_text):
     Uses OpenAI's GPT-4 to clean up the response and make it more readable for voice output.
     """
     try:
-        response = openai.chat.completions.create(
-            model="gpt-4o",
+        started = time.monotonic()
+        response = create_chat_completion(
+            model=MODEL_ROUTES["small"]["model"],
             messages=[
                 {"role": "system", "content": "Format this response for a voice assistant. Make it clear, short, and natural to read aloud."},
                 {"role": "user", "content": raw_text}
             ],
-            max_tokens=300
+            max_tokens=MODEL_ROUTES["small"]["max_tokens"]
         )
+        record_route_usage("small", started, response.usage)
         return response.choices[0].message.content.strip()
 
     except Exception as e:
@@ -236,85 +1455,1182 @@ def format_with_gpt4(raw_text):
         return raw_text  # Return raw text if formatting fails
 
 
-@app.route("/api/chat", methods=["POST"])
-def chat():
+def strip_markdown(text):
     """
-    Receives text from frontend, sends it to OpenAI API, and returns the response.
+    Removes markdown that would otherwise be read aloud (links, emphasis, headings, bullets).
     """
-    data = request.get_json()
-    user_message = data.get("message", "")
+    text = MARKDOWN_BLOCK.sub("", MARKDOWN_LINK.sub(r"\1", text))
+    for _ in range(3):  # Nested emphasis such as ***bold italic*** or **_both_**
+        text, replaced = MARKDOWN_EMPHASIS.subn(r"\2", text)
+        if not replaced:
+            break
+    return " ".join(text.split())
 
-    if not user_message:
-        return jsonify({"error": "No message provided"}), 400
+def count_phrase(count, noun):
+    """
+    "no emails", "one email", "3 emails" ...
+    """
+    number = NUMBER_WORDS[count] if count < len(NUMBER_WORDS) else str(count)
+    return f"{number} {noun}" if count == 1 else f"{number} {noun}s"
+
+def sender_name(from_header):
+    """
+    "Jane Doe <jane@example.com>" -> "Jane Doe"; a bare address gives its local part.
+    """
+    name, address = parseaddr(from_header)
+    if name:
+        return name.strip('"')
+    if address:
+        return address.split("@")[0].replace(".", " ").replace("_", " ")
+    return from_header or "an unknown sender"
+
+def spoken_time(moment):
+    """
+    3:30 PM, or just 9 AM on the hour.
+    """
+    hour = moment.hour % 12 or 12
+    suffix = "AM" if moment.hour < 12 else "PM"
+    return f"{hour} {suffix}" if moment.minute == 0 else f"{hour}:{moment.minute:02d} {suffix}"
 
+def humanize_date(value, now=None):
+    """
+    Turns an RFC 2822 email date or an ISO 8601 calendar date into speech, in
+    the server's local time: "today at 3:30 PM", "tomorrow", "on Friday at 9 AM",
+    "on March 4". Returns None if the value cannot be parsed.
+    """
+    all_day = False
     try:
-        print("user_message", user_message)
+        if ISO_DATE.match(value):
+            moment = datetime.fromisoformat(value.replace("Z", "+00:00"))
+            all_day = ":" not in value
+        else:
+            moment = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+
+    if moment.tzinfo:
+        moment = moment.astimezone()  # Local time zone
+    if now is None:
+        now = datetime.now(moment.tzinfo)
+
+    days = (moment.date() - now.date()).days
+    if days == 0:
+        day = "today"
+    elif days == 1:
+        day = "tomorrow"
+    elif days == -1:
+        day = "yesterday"
+    elif 1 < days < 7:
+        day = f"on {moment:%A}"
+    elif -7 < days < -1:
+        day = f"last {moment:%A}"
+    else:
+        day = f"on {moment:%B} {moment.day}"
+
+    return day if all_day else f"{day} at {spoken_time(moment)}"
+
+def spoken_snippet(snippet, limit=EMAIL_SNIPPET_CHARS):
+    """
+    Gmail snippets arrive HTML-escaped ("&#39;", "&amp;"); unescape them and cut
+    at a word boundary so the preview stays short when read aloud.
+    """
+    text = strip_markdown(html.unescape(snippet or ""))
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(" ", 1)[0].rstrip(",;:") + "..."
+
+def format_emails_for_voice(emails):
+    """
+    Local, deterministic replacement for the GPT-4o rewrite of the email list.
+    """
+    lines = [f"You have {count_phrase(len(emails), 'recent email')}."]
+    for i, email in enumerate(emails):
+        lead = ORDINAL_WORDS[i] if i < len(ORDINAL_WORDS) else "Next"
+        subject = strip_markdown(email["subject"]) or "no subject"
+        when = humanize_date(email["date"])
+        sender = sender_name(email["sender"])
+        lines.append(f"{lead}, from {sender}, {when}: {subject}." if when else f"{lead}, from {sender}: {subject}.")
+        snippet = spoken_snippet(email.get("snippet", ""))
+        if snippet:
+            lines.append(f"It says: {snippet}" if snippet[-1] in ".!?" else f"It says: {snippet}.")
+    return " ".join(lines)
+
+def format_events_for_voice(events):
+    """
+    Local, deterministic replacement for the GPT-4o rewrite of the event list.
+    """
+    lines = [f"You have {count_phrase(len(events), 'upcoming event')}."]
+    for event in events:
+        summary = strip_markdown(event.get("summary", "")) or "An untitled event"
+        start = event["start"].get("dateTime", event["start"].get("date"))
+        when = humanize_date(start)
+        if when and "dateTime" not in event["start"]:
+            when += ", all day"
+        lines.append(f"{summary}, {when}." if when else f"{summary}.")
+    return " ".join(lines)
+
+CHAT_TOOLS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "handle_email_action",
+            "description": "Perform actions related to emails",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "action": {"type": "string", "enum": ["read_emails", "send_email"]},
+                    "email_subject": {"type": "string"},
+                    "email_body": {"type": "string"},
+                },
+                "required": ["action"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "handle_calendar_action",
+            "description": "Perform actions related to calendar events",
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "action": {"type": "string", "enum": ["check_schedule", "create_event"]},
+                    "event_details": {"type": "string"},
+                },
+                "required": ["action"]
+            }
+        }
+    }
+]
+
+# The prompt prefix (system prompt and tool schemas) is built once at import
+# and sent byte-for-byte the same on every request, so OpenAI can serve it
+# from its prompt cache.
+SYSTEM_MESSAGE = {"role": "system", "content": KNOWLEDGE_BASE}
+PROMPT_PREFIX_HASH = hashlib.sha256(
+    json.dumps({"system": KNOWLEDGE_BASE, "tools": CHAT_TOOLS}, sort_keys=True).encode("utf-8")
+).hexdigest()
+prompt_cache_metrics = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+prompt_cache_metrics_lock = threading.Lock()
+
+# Tool-calling loop: every tool call the model asks for in a round runs in
+# parallel and the results go back to the model, for at most
+# MAX_TOOL_ITERATIONS rounds before it must answer.
+MAX_TOOL_ITERATIONS = int(os.getenv("MAX_TOOL_ITERATIONS", "3"))
+TOOL_MAX_WORKERS = int(os.getenv("TOOL_MAX_WORKERS", "8"))
+tool_executor = ThreadPoolExecutor(max_workers=TOOL_MAX_WORKERS, thread_name_prefix="tool")
+
+# Intent fast path: common, argument-free commands ("read my emails", "what's
+# on my calendar") are recognised locally and sent straight to their handler,
+# skipping the model's tool-calling round trip. A sample of fast-path turns is
+# re-checked against the model in the background to measure misroutes.
+INTENT_FAST_PATH = os.getenv("INTENT_FAST_PATH", "1") == "1"
+INTENT_MODEL = os.getenv("INTENT_MODEL", "0") == "1"  # nearest-prototype classifier, needs numpy
+INTENT_MODEL_THRESHOLD = float(os.getenv("INTENT_MODEL_THRESHOLD", "0.75"))
+INTENT_MAX_WORDS = 12
+INTENT_SHADOW_SAMPLE_RATE = float(os.getenv("INTENT_SHADOW_SAMPLE_RATE", "0.05"))
+# Rules match the whole utterance: an optional polite lead-in, the command,
+# then only a few filler words, so "check my email settings" is not a command.
+INTENT_LEAD_IN = r"^(?:(?:can|could|would|will) you |please )?"
+INTENT_FILLER = r"(?: (?:please|now|right now|today|for today))*$"
 
+def intent_rule(*commands):
+    return re.compile(INTENT_LEAD_IN + "(?:" + "|".join(commands) + ")" + INTENT_FILLER)
+
+INTENT_RULES = [
+    ("handle_email_action", {"action": "read_emails"}, intent_rule(
+        r"(?:read|check|show|open|go through|list) (?:me )?(?:my |the )?(?:new |latest |recent |unread )?(?:e ?mails?|inbox|mail)",
+        r"(?:do|did) i (?:have|get|got) (?:any )?(?:new |unread )?(?:e ?mails?|mail)",
+        r"any (?:new |unread )?(?:e ?mails?|mail)",
+        r"what(?:s| is| are) (?:in )?my (?:inbox|latest e ?mails?|new e ?mails?)",
+    )),
+    ("handle_calendar_action", {"action": "check_schedule"}, intent_rule(
+        r"what(?:s| is) (?:on )?my (?:calendar|schedule|agenda)",
+        r"(?:read|check|show|open|list) (?:me )?my (?:calendar|schedule|agenda|upcoming events)",
+        r"do i have (?:any )?(?:upcoming )?(?:meetings|events|appointments)",
+        r"what (?:meetings|events|appointments) do i have(?: coming up)?",
+    )),
+]
+# Anything that asks for a change, or for more than one thing, goes to the model
+INTENT_BLOCKERS = re.compile(
+    r"\b(?:send|write|draft|reply|forward|compose|create|add|book|schedule (?:a|an|my)|set up|cancel|move|delete|"
+    r"remove|reschedule|and|then|also|from|about|summari[sz]e)\b"
+)
+INTENT_PROTOTYPES = {
+    ("handle_email_action", "read_emails"): [
+        "read my emails", "check my inbox", "do i have any new emails", "what's in my inbox",
+        "any new mail", "read me my latest emails",
+    ],
+    ("handle_calendar_action", "check_schedule"): [
+        "what's on my calendar", "check my schedule", "do i have any meetings", "what's my agenda",
+        "what events do i have coming up", "show my upcoming events",
+    ],
+    None: [
+        "send an email to", "create a calendar event", "schedule a meeting", "tell me about yourself",
+        "who made you", "hello", "what can you do",
+    ],
+}
+intent_metrics = {"requests": 0, "fast_path": 0, "rules": 0, "model": 0, "shadow_checks": 0, "misroutes": 0}
+intent_metrics_lock = threading.Lock()
+intent_shadow_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="intent-shadow")
+
+@lru_cache(maxsize=None)
+def token_encoding(model):
+    """
+    tiktoken encoding for the model, or None if tiktoken or its data is unavailable.
+    """
+    if tiktoken is None:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("o200k_base")
+    except Exception as e:  # The encoding file is downloaded on first use
+        print(f"Error loading tiktoken encoding, estimating token counts: {e}")
+        return None
+
+@lru_cache(maxsize=8192)
+def count_tokens(model, text):
+    """
+    Token count of text for the model; cached, so each message is encoded once.
+    """
+    encoding = token_encoding(model)
+    if encoding is None:
+        return len(text) // 4 + 1  # Rough estimate
+    return len(encoding.encode(text))
+
+def message_tokens(model, message):
+    return count_tokens(model, message["content"] or "") + MESSAGE_TOKEN_OVERHEAD
+
+def history_cut(messages, model, ratio=HISTORY_TRIM_RATIO):
+    """
+    Index of the first message to keep for the model's token budget: 0 while
+    the messages fit, otherwise enough of the oldest are dropped to fit `ratio`
+    of the budget. The latest message is always kept.
+    """
+    budget = HISTORY_TOKEN_BUDGETS.get(model, DEFAULT_HISTORY_TOKEN_BUDGET)
+    if sum(message_tokens(model, message) for message in messages) <= budget:
+        return 0
+    budget = int(budget * ratio)
+    used = 0
+    keep_from = len(messages)
+    while keep_from > 0:
+        tokens = message_tokens(model, messages[keep_from - 1])
+        if used + tokens > budget and keep_from < len(messages):
+            break
+        used += tokens
+        keep_from -= 1
+    return keep_from
+
+def trim_history(model=HISTORY_WINDOW_MODEL):
+    """
+    Once the history exceeds the model's token budget, drops the oldest turns
+    until it fits HISTORY_TRIM_RATIO of the budget, always keeping the latest
+    message. Returns the evicted messages.
+    """
+    keep_from = history_cut(conversation_history, model)
+    evicted = conversation_history[:keep_from]
+    del conversation_history[:keep_from]
+    return evicted
+
+def start_turn(user_message, model=CHAT_MODEL):
+    """
+    Appends the user's message and trims the shared window, then returns a
+    snapshot of the history before that message, cut to the budget of the
+    model the turn is routed to. Requests build their prompt from the
+    snapshot, not from the shared list, which concurrent requests append to.
+    """
+    with conversation_history_lock:
         conversation_history.append({"role": "user", "content": user_message})
-        conversation_history[:] = conversation_history[-100:]
-        response = openai.chat.completions.create(
-            model="gpt-4o",  # Use GPT-4o or any available model
+        evicted = trim_history()
+        messages = conversation_history[:]
+    remember_evicted(evicted)
+    # Only this turn's copy shrinks, so a small-route turn costs later turns no context
+    return messages[history_cut(messages, model, ratio=1.0):-1]
+
+def end_turn(ai_response):
+    """
+    Appends the assistant's reply to the shared history, under the same lock
+    as start_turn.
+    """
+    with conversation_history_lock:
+        conversation_history.append({"role": "assistant", "content": ai_response})
+
+def remember_evicted(evicted):
+    """
+    Queues turns that fell out of the window for the background memory update.
+    """
+    if not CONVERSATION_MEMORY or not evicted:
+        return
+    with conversation_memory_lock:
+        conversation_memory["pending"].extend(evicted)
+    memory_executor.submit(update_conversation_memory)
+
+def update_conversation_memory():
+    """
+    Folds the pending evicted turns into the running summary. Only the new
+    turns are sent, together with the previous summary.
+    """
+    with conversation_memory_lock:
+        pending = conversation_memory["pending"]
+        conversation_memory["pending"] = []
+        summary = conversation_memory["summary"]
+    if not pending:
+        return  # An earlier update already picked these up
+
+    transcript = "\n".join(f"{message['role']}: {message['content']}" for message in pending)
+    try:
+        response = create_chat_completion(
+            model=MEMORY_MODEL,
             messages=[
-                {"role": "system", "content": KNOWLEDGE_BASE},
-                {"role": "user", "content": user_message}
-            ] + conversation_history,
-            functions=[
-                {
-                    "name": "handle_email_action",
-                    "description": "Perform actions related to emails",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "action": {"type": "string", "enum": ["read_emails", "send_email"]},
-                            "email_subject": {"type": "string"},
-                            "email_body": {"type": "string"},
-                        },
-                        "required": ["action"]
-                    }
-                },
-                {
-                    "name": "handle_calendar_action",
-                    "description": "Perform actions related to calendar events",
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "action": {"type": "string", "enum": ["check_schedule", "create_event"]},
-                            "event_details": {"type": "string"},
-                        },
-                        "required": ["action"]
-                    }
-                }
+                {"role": "system", "content": (
+                    "You maintain the running memory of a conversation between Uchechukwu and his assistant Clark. "
+                    "Merge the new turns into the existing memory. Keep names, facts, preferences, decisions and open "
+                    f"questions; drop small talk. Reply with the updated memory only, in at most {MEMORY_MAX_WORDS} words."
+                )},
+                {"role": "user", "content": f"Existing memory:\n{summary or '(empty)'}\n\nNew turns:\n{transcript}"}
             ],
-            function_call="auto",
-            max_tokens=2000
+            max_tokens=MEMORY_MAX_WORDS * 2
         )
-        if response.choices[0].message.function_call:
-            function_name = response.choices[0].message.function_call.name
-            arguments = json.loads(response.choices[0].message.function_call.arguments)
-
-            if function_name == "handle_email_action":
-                ai_response = handle_email_action(**arguments)
-                audio_file = speak_response_google(ai_response)
-            elif function_name == "handle_calendar_action":
-                ai_response = handle_calendar_action(**arguments)
-                audio_file = speak_response_google(ai_response)
+        new_summary = response.choices[0].message.content.strip()
+    except Exception as e:
+        print(f"Error updating conversation memory: {e}")
+        with conversation_memory_lock:
+            conversation_memory["pending"][:0] = pending  # Retry with the next eviction
+        return
+
+    with conversation_memory_lock:
+        conversation_memory["summary"] = new_summary
+        conversation_memory["updates"] += 1
+
+def build_chat_messages(user_message, history):
+    """
+    Prompt for the current turn, ordered from most to least stable: system
+    prompt, history (the snapshot from start_turn), the running memory, then
+    the user message. The memory changes in the background, so it goes after
+    the history to keep the cacheable prefix intact.
+    """
+    messages = [SYSTEM_MESSAGE] + history
+    if conversation_memory["summary"]:
+        messages.append({"role": "system", "content": f"Summary of the earlier conversation:\n{conversation_memory['summary']}"})
+    return messages + [{"role": "user", "content": user_message}]
+
+def record_prompt_usage(usage):
+    """
+    Adds a completion's prompt token counts, including the prompt-cache hits
+    reported in usage.prompt_tokens_details, to the metrics.
+    """
+    details = getattr(usage, "prompt_tokens_details", None)
+    with prompt_cache_metrics_lock:
+        prompt_cache_metrics["requests"] += 1
+        prompt_cache_metrics["prompt_tokens"] += usage.prompt_tokens or 0
+        prompt_cache_metrics["cached_tokens"] += getattr(details, "cached_tokens", 0) or 0
+
+def prompt_cache_stats():
+    with prompt_cache_metrics_lock:
+        stats = dict(prompt_cache_metrics)
+    stats["cached_ratio"] = round(stats["cached_tokens"] / stats["prompt_tokens"], 3) if stats["prompt_tokens"] else 0.0
+    return stats
+
+def run_function_call(function_name, arguments):
+    """
+    Dispatches a function call requested by the model to its handler.
+    """
+    if function_name == "handle_email_action":
+        return handle_email_action(**arguments)
+    elif function_name == "handle_calendar_action":
+        return handle_calendar_action(**arguments)
+    else:
+        return "Unknown function request."
+
+def execute_tool_calls(tool_calls):
+    """
+    Runs the model's tool calls concurrently and returns them as tool messages,
+    in the order the model asked for them.
+    """
+    def run(tool_call):
+        try:
+            arguments = json.loads(tool_call["arguments"] or "{}")
+            return run_function_call(tool_call["name"], arguments)
+        except Exception as e:
+            print(f"Error running tool {tool_call['name']}: {e}")
+            return f"Error running {tool_call['name']}: {e}"
+
+    results = tool_executor.map(run, tool_calls)
+    return [
+        {"role": "tool", "tool_call_id": tool_call["id"], "content": result}
+        for tool_call, result in zip(tool_calls, results)
+    ]
+
+def tool_call_round(content, tool_calls):
+    """
+    Messages for one tool-calling round: the assistant's request and the tool results.
+    """
+    assistant_message = {
+        "role": "assistant",
+        "content": content,
+        "tool_calls": [
+            {"id": tool_call["id"], "type": "function",
+             "function": {"name": tool_call["name"], "arguments": tool_call["arguments"]}}
+            for tool_call in tool_calls
+        ]
+    }
+    return [assistant_message] + execute_tool_calls(tool_calls)
+
+def choose_route(user_message):
+    """
+    Picks the model route for a turn: short small talk goes to the small
+    model, long messages and anything that hints at tools or reasoning to
+    the large one.
+    """
+    if not MODEL_ROUTING:
+        return "large"
+    text = normalize_utterance(user_message)
+    if len(text.split()) > ROUTE_SMALL_MAX_WORDS or ROUTE_LARGE_HINTS.search(text):
+        return "large"
+    return "small"
+
+def record_route_usage(route_name, started, usage):
+    """
+    Adds one completion's latency, token counts and cost to its route's metrics.
+    """
+    route = MODEL_ROUTES[route_name]
+    prompt_tokens = (usage.prompt_tokens or 0) if usage else 0
+    completion_tokens = (usage.completion_tokens or 0) if usage else 0
+    with route_metrics_lock:
+        metrics = route_metrics[route_name]
+        metrics["requests"] += 1
+        metrics["latency"] += time.monotonic() - started
+        metrics["prompt_tokens"] += prompt_tokens
+        metrics["completion_tokens"] += completion_tokens
+        metrics["cost"] += (prompt_tokens * route["input_cost"] + completion_tokens * route["output_cost"]) / 1_000_000
+
+def route_stats():
+    with route_metrics_lock:
+        stats = {route_name: dict(metrics) for route_name, metrics in route_metrics.items()}
+    for route_name, metrics in stats.items():
+        metrics["model"] = MODEL_ROUTES[route_name]["model"]
+        metrics["avg_latency"] = round(metrics["latency"] / metrics["requests"], 3) if metrics["requests"] else 0.0
+        metrics["latency"] = round(metrics["latency"], 3)
+        metrics["cost"] = round(metrics["cost"], 6)
+    return stats
+
+def chat_completion_options(iteration):
+    # On the last round the model has to answer with text
+    return {"tool_choice": "none"} if iteration == MAX_TOOL_ITERATIONS else {}
+
+class ResponseCache:
+    """
+    LRU cache of chat replies with a time-to-live. Entries hold the reply
+    text and the audio clip ids already rendered for it, per format.
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (expires_at, entry)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._entries.get(key)
+            if item is None or item[0] < time.monotonic():
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, entry)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+response_cache = ResponseCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL)
+
+class LocalHashEmbedder:
+    """
+    Offline embedder: hashes words and character trigrams into a fixed-size
+    signed vector. Catches rephrasings that share most of their wording.
+    """
+    name = "local"
+
+    def __init__(self, dimensions=LOCAL_EMBEDDING_DIMENSIONS):
+        self.dimensions = dimensions
+
+    def embed(self, text):
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        words = re.findall(r"\w+", text.lower())
+        features = words + [f"#{word[i:i + 3]}" for word in words for i in range(max(len(word) - 2, 1))]
+        for feature in features:
+            digest = hashlib.blake2b(feature.encode("utf-8"), digest_size=8).digest()
+            index = int.from_bytes(digest[:4], "little") % self.dimensions
+            vector[index] += 1.0 if digest[4] & 1 else -1.0
+        return normalize_embedding(vector)
+
+class OpenAIEmbedder:
+    """
+    Embeds with the OpenAI embeddings API; better at paraphrases, costs a request.
+    """
+    name = "openai"
+
+    def __init__(self, model=OPENAI_EMBEDDING_MODEL, dimensions=OPENAI_EMBEDDING_DIMENSIONS):
+        self.model = model
+        self.dimensions = dimensions
+
+    def embed(self, text):
+        response = openai_request(lambda client: client.embeddings.create(model=self.model, input=text, dimensions=self.dimensions))
+        return normalize_embedding(np.asarray(response.data[0].embedding, dtype=np.float32))
+
+def normalize_embedding(vector):
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class SemanticCacheBlock:
+    """
+    Rows of one context id: a float32 matrix grown by doubling. Rows are only
+    written in place past the current size, and compaction builds new
+    arrays, so a snapshot stays valid while the block changes.
+    """
+
+    def __init__(self, dimensions):
+        self.matrix = np.zeros((4, dimensions), dtype=np.float32)
+        self.expires = np.zeros(4, dtype=np.float64)
+        self.entries = []
+        self.size = 0
+
+    def snapshot(self):
+        return self.matrix[:self.size], self.expires[:self.size], self.entries
+
+    def append(self, embedding, expires, entry):
+        if self.size == len(self.matrix):
+            capacity = max(4, self.size * 2)
+            matrix = np.zeros((capacity, self.matrix.shape[1]), dtype=np.float32)
+            matrix[:self.size] = self.matrix[:self.size]
+            self.matrix = matrix
+            self.expires = np.concatenate([self.expires[:self.size], np.zeros(capacity - self.size)])
+        self.matrix[self.size] = embedding
+        self.expires[self.size] = expires
+        self.entries.append(entry)
+        self.size += 1
+
+    def compact(self, now):
+        """
+        Drops expired rows and returns how many were dropped.
+        """
+        live = np.flatnonzero(self.expires[:self.size] >= now)
+        dropped = self.size - len(live)
+        if dropped:
+            self.matrix = self.matrix[live]
+            self.expires = self.expires[live]
+            self.entries = [self.entries[i] for i in live]
+            self.size = len(live)
+        return dropped
+
+class SemanticCache:
+    """
+    Nearest-neighbour cache over unit-length query embeddings. Only rows with
+    the same context id can match, so rows are grouped in one block per
+    context and a lookup scores just that block, with a matrix-vector product
+    on a snapshot taken outside the lock. Expired rows are dropped by
+    compact(); when the cache is full, the least recently written contexts go.
+    """
+
+    def __init__(self, dimensions, max_entries, ttl, threshold):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.threshold = threshold
+        self.hits = 0
+        self.misses = 0
+        self.compactions = 0
+        self._size = 0
+        self._dimensions = dimensions
+        self._blocks = OrderedDict()  # context id -> SemanticCacheBlock, least recently written first
+        self._lock = threading.Lock()
+
+    def search(self, embedding, context_id):
+        with self._lock:
+            block = self._blocks.get(context_id)
+            snapshot = block.snapshot() if block is not None else None
+        entry = None
+        if snapshot is not None:
+            matrix, expires, entries = snapshot
+            scores = matrix @ embedding
+            scores[expires < time.monotonic()] = -1.0
+            best = int(np.argmax(scores))
+            if scores[best] >= self.threshold:
+                entry = entries[best]
+        with self._lock:
+            if entry is None:
+                self.misses += 1
             else:
-                ai_response = "Unknown function request."
-                audio_file = speak_response_google(ai_response)
-        else:
-            ai_response = response.choices[0].message.content
-            audio_file = speak_response_google(ai_response)
+                self.hits += 1
+        return entry
 
-        conversation_history.append({"role": "assistant", "content": ai_response})
-        return jsonify({"response": ai_response, "audio": audio_file})
+    def add(self, embedding, context_id, entry):
+        with self._lock:
+            if self._size >= self.max_entries:
+                self._compact()
+            if self._size >= self.max_entries:
+                # Evict in batches so a full cache does not compact on every add
+                while self._blocks and self._size > self.max_entries * 0.9:
+                    _, block = self._blocks.popitem(last=False)
+                    self._size -= block.size
+            block = self._blocks.pop(context_id, None) or SemanticCacheBlock(self._dimensions)
+            self._blocks[context_id] = block
+            block.append(embedding, time.monotonic() + self.ttl, entry)
+            self._size += 1
+
+    def compact(self):
+        with self._lock:
+            self._compact()
+
+    def _compact(self):
+        now = time.monotonic()
+        dropped = 0
+        for context_id, block in list(self._blocks.items()):
+            dropped += block.compact(now)
+            if not block.size:
+                del self._blocks[context_id]
+        if dropped:
+            self._size -= dropped
+            self.compactions += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                "entries": self._size,
+                "contexts": len(self._blocks),
+                "capacity": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "compactions": self.compactions,
+                "embedder": semantic_embedder.name,
+            }
+
+def semantic_cache_compactor():
+    """
+    Periodically drops expired rows so the index stays dense.
+    """
+    while True:
+        time.sleep(SEMANTIC_CACHE_COMPACT_INTERVAL)
+        try:
+            semantic_cache.compact()
+        except Exception as e:
+            print(f"Semantic cache compaction failed: {e}")
+
+semantic_embedder = None
+semantic_cache = None
+if SEMANTIC_CACHE and np is None:
+    print("SEMANTIC_CACHE is on but numpy is not installed; semantic cache disabled")
+elif SEMANTIC_CACHE:
+    semantic_embedder = OpenAIEmbedder() if SEMANTIC_CACHE_EMBEDDER == "openai" else LocalHashEmbedder()
+    semantic_cache = SemanticCache(semantic_embedder.dimensions, SEMANTIC_CACHE_MAX_ENTRIES, RESPONSE_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD)
+
+def normalize_utterance(text):
+    text = unicodedata.normalize("NFKC", text).lower().replace("’", "'")
+    text = re.sub(r"[^\w\s']", " ", text).replace("'", "")
+    return " ".join(text.split())
+
+class IntentPrototypeClassifier:
+    """
+    Tiny offline classifier: nearest labelled prototype utterance by cosine
+    similarity of LocalHashEmbedder vectors. Prototypes labelled None stand
+    for requests that must go to the model.
+    """
+
+    def __init__(self, prototypes, threshold):
+        self.embedder = LocalHashEmbedder()
+        self.threshold = threshold
+        self.labels = [label for label, examples in prototypes.items() for _ in examples]
+        self.matrix = np.stack([
+            self.embedder.embed(normalize_utterance(example))
+            for examples in prototypes.values() for example in examples
+        ])
+
+    def classify(self, text):
+        scores = self.matrix @ self.embedder.embed(text)
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+        return self.labels[best]
+
+intent_classifier = None
+if INTENT_FAST_PATH and INTENT_MODEL and np is None:
+    print("INTENT_MODEL is on but numpy is not installed; using keyword rules only")
+elif INTENT_FAST_PATH and INTENT_MODEL:
+    intent_classifier = IntentPrototypeClassifier(INTENT_PROTOTYPES, INTENT_MODEL_THRESHOLD)
+
+def classify_intent(user_message):
+    """
+    Returns (function_name, arguments, source) for a command that can skip
+    the model, or None when the message is not a confident match.
+    """
+    text = normalize_utterance(user_message)
+    if not text or len(text.split()) > INTENT_MAX_WORDS or INTENT_BLOCKERS.search(text):
+        return None
+    for function_name, arguments, pattern in INTENT_RULES:
+        if pattern.match(text):
+            return function_name, arguments, "rules"
+    if intent_classifier is not None:
+        label = intent_classifier.classify(text)
+        if label is not None:
+            function_name, action = label
+            return function_name, {"action": action}, "model"
+    return None
+
+def intent_shadow_check(messages, function_name, arguments):
+    """
+    Asks the model what it would have done with a fast-path turn and counts
+    a misroute when it would not have made the same call.
+    """
+    try:
+        response = create_chat_completion(
+            model=CHAT_MODEL,
+            messages=messages,
+            tools=CHAT_TOOLS,
+            max_tokens=100
+        )
+        tool_calls = response.choices[0].message.tool_calls or []
+        agreed = any(
+            tool_call.function.name == function_name
+            and json.loads(tool_call.function.arguments or "{}").get("action") == arguments["action"]
+            for tool_call in tool_calls
+        )
+    except Exception as e:
+        print(f"Intent shadow check failed: {e}")
+        return
+    with intent_metrics_lock:
+        intent_metrics["shadow_checks"] += 1
+        intent_metrics["misroutes"] += 0 if agreed else 1
+    if not agreed:
+        print(f"Intent fast path misroute: {messages[-1]['content']!r} -> {function_name} {arguments}")
+
+def fast_path_reply(user_message, history):
+    """
+    Runs a locally recognised command straight through its handler. Returns
+    (function_name, arguments, reply), or None to go through the model.
+    """
+    if not INTENT_FAST_PATH:
+        return None
+    intent = classify_intent(user_message)
+    with intent_metrics_lock:
+        intent_metrics["requests"] += 1
+    if intent is None:
+        return None
+
+    function_name, arguments, source = intent
+    try:
+        reply = run_function_call(function_name, dict(arguments))
+    except Exception as e:
+        print(f"Fast path {function_name} failed, falling back to the model: {e}")
+        return None
+
+    with intent_metrics_lock:
+        intent_metrics["fast_path"] += 1
+        intent_metrics[source] += 1
+    if random.random() < INTENT_SHADOW_SAMPLE_RATE:
+        intent_shadow_executor.submit(intent_shadow_check, build_chat_messages(user_message, history), function_name, arguments)
+    return function_name, arguments, reply
+
+def intent_stats():
+    with intent_metrics_lock:
+        stats = dict(intent_metrics)
+    stats["hit_rate"] = round(stats["fast_path"] / stats["requests"], 3) if stats["requests"] else 0.0
+    stats["misroute_rate"] = round(stats["misroutes"] / stats["shadow_checks"], 3) if stats["shadow_checks"] else 0.0
+    return stats
+
+def response_cache_context(model, history):
+    """
+    Everything besides the user message that determines the reply: model,
+    prompt prefix (system prompt and tool schemas) and the last few turns of
+    history.
+    """
+    context = history[-RESPONSE_CACHE_CONTEXT_MESSAGES:] if RESPONSE_CACHE_CONTEXT_MESSAGES else []
+    return {
+        "model": model,
+        "prefix": PROMPT_PREFIX_HASH,
+        "context": [[message["role"], message["content"]] for message in context],
+    }
+
+def response_cache_key(model, user_message, history):
+    """
+    Canonical hash of the reply context plus the user message (case and
+    whitespace folded).
+    """
+    payload = dict(response_cache_context(model, history), message=" ".join(user_message.lower().split()))
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+def lookup_cached_reply(model, user_message, history):
+    """
+    Looks the turn up in the exact-match cache, then the semantic
+    cache. Returns (lookup, entry): lookup holds the keys needed to store a
+    fresh reply and is None when caching is off; entry is None on a miss.
+    """
+    if not RESPONSE_CACHE:
+        return None, None
+    lookup = {"key": response_cache_key(model, user_message, history), "context_id": None, "embedding": None}
+    entry = response_cache.get(lookup["key"])
+    if entry is not None or semantic_cache is None:
+        return lookup, entry
+
+    context = json.dumps(response_cache_context(model, history), sort_keys=True).encode("utf-8")
+    lookup["context_id"] = int.from_bytes(hashlib.sha256(context).digest()[:8], "big", signed=True)
+    try:
+        lookup["embedding"] = semantic_embedder.embed(user_message)
+    except Exception as e:
+        print(f"Embedding failed, skipping semantic cache: {e}")
+        return lookup, None
+    return lookup, semantic_cache.search(lookup["embedding"], lookup["context_id"])
+
+def cached_reply_audio(entry, audio_mode, audio_format):
+    """
+    Clip id already rendered for a cached reply, if it is still available. A
+    finished clip beats a stream or ticket, so every audio mode gets it.
+    """
+    clip_id = entry["audio"].get(audio_format)
+    if audio_mode == "none" or not clip_id:
+        return None
+    if clip_id in phrase_bank_clips or clip_is_cached(clip_id):
+        return clip_id
+    return None
+
+def remember_reply(lookup, cache_entry, ai_response, audio_file, audio_mode, audio_format):
+    """
+    Stores a fresh reply (or the audio rendered for a cached one) in the response cache.
+    """
+    if cache_entry is None:
+        cache_entry = {"response": ai_response, "audio": {}}
+        response_cache.put(lookup["key"], cache_entry)
+        if lookup["embedding"] is not None:
+            semantic_cache.add(lookup["embedding"], lookup["context_id"], cache_entry)
+    if audio_mode != "none" and audio_file:
+        # Streams and tickets end up in the clip cache under the reply's content id
+        clip_id = audio_file if "/" not in audio_file else audio_clip_id(normalize_tts_text(ai_response), audio_format)
+        cache_entry["audio"][audio_format] = clip_id
+
+def sse_event(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def chat_turn(user_message, audio_mode, audio_format):
+    """
+    One chat turn, shared by the Flask routes and the ASGI server. The
+    generator does no I/O itself; it yields what it needs and is sent back
+    the result:
+      ("call", fn, *args)        -> fn(*args), for blocking helpers
+      ("completion", kwargs)     -> a streamed chat completion
+      ("chunk", stream)          -> the next chunk, or None at the end
+      ("audio", text, mode, fmt) -> the audio reference from render_audio
+      ("event", name, data)      -> nothing; an event for the client
+    The last event is "done" (full response and audio) or "error".
+    """
+    try:
+        print("user_message", user_message)
+
+        route_name = choose_route(user_message)
+        route = MODEL_ROUTES[route_name]
+        history = start_turn(user_message, route["model"])  # Trim for the model that will see it
+
+        fast_path = yield "call", fast_path_reply, user_message, history
+        if fast_path is not None:
+            function_name, arguments, ai_response = fast_path
+            yield "event", "tool_call", {"id": None, "name": function_name, "arguments": arguments}
+            yield "event", "token", {"delta": ai_response}
+            audio_file = yield "audio", ai_response, audio_mode, audio_format
+            end_turn(ai_response)
+            yield "event", "done", {"response": ai_response, "audio": audio_file, "audio_format": audio_format, "fast_path": True}
+            return
+
+        cache_lookup, cache_entry = yield "call", lookup_cached_reply, route["model"], user_message, history
+        if cache_entry is not None:
+            ai_response = cache_entry["response"]
+            yield "event", "token", {"delta": ai_response}
+            audio_file = yield "call", cached_reply_audio, cache_entry, audio_mode, audio_format
+            if not audio_file:
+                audio_file = yield "audio", ai_response, audio_mode, audio_format
+            remember_reply(cache_lookup, cache_entry, ai_response, audio_file, audio_mode, audio_format)
+            end_turn(ai_response)
+            yield "event", "done", {"response": ai_response, "audio": audio_file, "audio_format": audio_format, "cached": True}
+            return
+
+        used_tools = False
+        messages = build_chat_messages(user_message, history)
+        for iteration in range(MAX_TOOL_ITERATIONS + 1):
+            started = time.monotonic()
+            stream = yield "completion", dict(
+                model=route["model"],
+                messages=messages,
+                tools=CHAT_TOOLS,
+                max_tokens=route["max_tokens"],
+                stream=True,
+                stream_options={"include_usage": True},
+                **chat_completion_options(iteration)
+            )
+
+            content = []
+            tool_calls = {}  # index -> {"id", "name", "arguments"}, assembled from deltas
+            usage = None
+            while True:
+                chunk = yield "chunk", stream
+                if chunk is None:
+                    break
+                if chunk.usage:  # Sent in a final chunk with no choices
+                    usage = chunk.usage
+                    record_prompt_usage(usage)
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                if delta.content:
+                    content.append(delta.content)
+                    yield "event", "token", {"delta": delta.content}
+                add_tool_call_deltas(tool_calls, delta.tool_calls)
+
+            record_route_usage(route_name, started, usage)
+            if not tool_calls:
+                ai_response = "".join(content)
+                break
+
+            tool_calls = [tool_calls[index] for index in sorted(tool_calls)]
+            for tool_call in tool_calls:
+                try:
+                    arguments = json.loads(tool_call["arguments"] or "{}")
+                except ValueError:
+                    arguments = tool_call["arguments"]
+                yield "event", "tool_call", {"id": tool_call["id"], "name": tool_call["name"], "arguments": arguments}
+            messages += yield "call", tool_call_round, "".join(content) or None, tool_calls
+            used_tools = True
+
+        audio_file = yield "audio", ai_response, audio_mode, audio_format
+        if cache_lookup and not used_tools:  # Tool replies depend on live data
+            remember_reply(cache_lookup, None, ai_response, audio_file, audio_mode, audio_format)
+
+        end_turn(ai_response)
+        yield "event", "done", {"response": ai_response, "audio": audio_file, "audio_format": audio_format}
 
     except Exception as e:
         print("error", e)
-        return jsonify({"error": str(e)}), 500
+        yield "event", "error", {"error": str(e)}
+
+def run_chat_turn(turn):
+    """
+    Drives chat_turn on the calling thread, yielding its (event, data) pairs.
+    Errors are thrown back into the turn, which reports them as an "error" event.
+    """
+    result, error = None, None
+    try:
+        while True:
+            try:
+                step = turn.throw(error) if error is not None else turn.send(result)
+            except StopIteration:
+                return
+            result, error = None, None
+            try:
+                if step[0] == "event":
+                    yield step[1], step[2]
+                elif step[0] == "call":
+                    result = step[1](*step[2:])
+                elif step[0] == "completion":
+                    result = chat_completion_stream(step[1])
+                elif step[0] == "chunk":
+                    result = next(step[1], None)
+                elif step[0] == "audio":
+                    result = render_audio(*step[1:])
+            except Exception as e:
+                error = e
+    finally:
+        turn.close()
+
+@app.route("/api/chat", methods=["POST"])
+def chat():
+    """
+    Receives text from frontend, sends it to OpenAI API, and returns the response.
+    """
+    data = request.get_json()
+    user_message = data.get("message", "")
+    audio_mode = data.get("audio_mode", "file")  # "file", "stream", "deferred", "lazy" or "none"
+    audio_format = negotiate_audio_format(data.get("audio_format"))
+
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+
+    for event, payload in run_chat_turn(chat_turn(user_message, audio_mode, audio_format)):
+        if event == "done":
+            return jsonify(payload)
+        if event == "error":
+            return jsonify(payload), 500
+
+@app.route("/api/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Same as /api/chat, but streams the reply as Server-Sent Events:
+    "token" events carry text deltas as the model generates them, "tool_call"
+    announces each tool the model calls, "done" carries the full response and
+    audio reference, and "error" reports a failure.
+    """
+    data = request.get_json()
+    user_message = data.get("message", "")
+    audio_mode = data.get("audio_mode", "file")
+    audio_format = negotiate_audio_format(data.get("audio_format"))
+
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+
+    def generate():
+        for event, payload in run_chat_turn(chat_turn(user_message, audio_mode, audio_format)):
+            yield sse_event(event, payload)
+
+    response = Response(stream_with_context(generate()), mimetype="text/event-stream")
+    response.cache_control.no_cache = True
+    response.headers["X-Accel-Buffering"] = "no"  # Don't let nginx buffer the stream
+    return response
+
+@app.route("/api/health")
+def health():
+    """
+    Reports whether the TTS channel is usable.
+    """
+    status = 503 if tts_health["healthy"] is False else 200
+    return jsonify({
+        "status": "ok" if status == 200 else "degraded",
+        "tts": dict(tts_health, backend=tts_backend.name),
+    }), status
+
+@app.route("/api/metrics")
+def metrics():
+    return jsonify({
+        "audio_janitor": audio_janitor_metrics,
+        "memory_audio_store": memory_audio_store.stats(),
+        "phrase_bank": {"phrases": len(phrase_bank_index)},
+        "tts_fragments": fragment_stats(),
+        "response_cache": response_cache.stats(),
+        "semantic_cache": semantic_cache.stats() if semantic_cache is not None else None,
+        "prompt_cache": prompt_cache_stats(),
+        "intent_fast_path": intent_stats(),
+        "model_routes": route_stats(),
+        "openai_pool": openai_pool_stats(),
+        "hedging": hedge_stats() if HEDGING else None,
+        "conversation_memory": {
+            "updates": conversation_memory["updates"],
+            "pending_turns": len(conversation_memory["pending"]),
+            "summary_words": len(conversation_memory["summary"].split()),
+        },
+    })
+
+def add_audio_cache_headers(response):
+    response.cache_control.public = True
+    response.cache_control.max_age = AUDIO_CACHE_MAX_AGE
+    response.cache_control.immutable = True
+    response.accept_ranges = "bytes"
+    return response
 
 @app.route("/audio/<filename>")
 def get_audio(filename):
-    return send_from_directory(AUDIO_DIR, filename)  # Ensure the correct directory is used
+    """
+    Serves a clip with a strong ETag (its immutable id), conditional GET (304)
+    and byte-range (206) support.
+    """
+    etag = os.path.splitext(filename)[0]
+
+    audio_content = phrase_bank_clips.get(filename)
+    if audio_content is None:
+        audio_content = memory_audio_store.get(filename)
+    if audio_content is not None:
+        # The stored bytes object is handed to the server as-is, without a copy
+        response = Response(audio_content, mimetype=audio_mimetype(filename))
+        response.set_etag(etag)
+        response = response.make_conditional(request, accept_ranges=True, complete_length=len(audio_content))
+        return add_audio_cache_headers(response)
+
+    shard = filename[:2]
+    if AUDIO_SHARD.fullmatch(shard) and os.path.exists(audio_path(filename)):
+        directory = os.path.join(AUDIO_DIR, shard)
+    else:
+        directory = AUDIO_DIR  # Clips written before sharding
+
+    # An explicit ETag, since the default one changes whenever a cache hit bumps the mtime
+    response = send_from_directory(directory, filename, etag=etag, conditional=True, max_age=AUDIO_CACHE_MAX_AGE)
+    return add_audio_cache_headers(response)
+
+@app.route("/audio/ticket/<ticket_id>")
+def get_audio_ticket(ticket_id):
+    """
+    Serves a ticket's clip, waiting for synthesis that is still in flight (or
+    starting it, for lazy tickets).
+    """
+    with audio_tickets_lock:
+        entry = audio_tickets.get(ticket_id)
+
+    if entry is None:
+        if AUDIO_CLIP_ID.fullmatch(ticket_id) and clip_is_cached(ticket_id):
+            return get_audio(ticket_id)  # Issued by another worker, already synthesized
+        return jsonify({"error": "Unknown audio ticket"}), 404
+
+    _, text, audio_format, future = entry
+    redeem_audio_ticket(text, audio_format, future)  # No-op unless this is the first GET of a lazy ticket
+
+    try:
+        clip_id = future.result(timeout=AUDIO_TICKET_TIMEOUT)
+    except FutureTimeoutError:
+        return jsonify({"error": "Audio is not ready yet"}), 504
+    except Exception as e:
+        print(f"Error synthesizing ticket {ticket_id}: {e}")
+        return jsonify({"error": str(e)}), 500
+
+    return get_audio(clip_id)
+
+@app.route("/audio/stream/<stream_id>")
+def get_audio_stream(stream_id):
+    """
+    Streams MP3 audio for a response as each sentence finishes synthesizing.
+    """
+    with audio_streams_lock:
+        entry = audio_streams.get(stream_id)
+
+    if entry is None or time.monotonic() - entry[0] > AUDIO_STREAM_TTL:
+        if AUDIO_CLIP_ID.fullmatch(stream_id) and clip_is_cached(stream_id):
+            return get_audio(stream_id)  # Finished, or started by another worker
+        return jsonify({"error": "Unknown audio stream"}), 404
+
+    _, mimetype, chunks = entry
+
+    def generate():
+        try:
+            yield from chunks.read(AUDIO_STREAM_CHUNK_TIMEOUT)
+        except TimeoutError:
+            print(f"Audio stream {stream_id} timed out")
+
+    response = Response(stream_with_context(generate()), mimetype=mimetype)
+    response.cache_control.no_store = True  # The buffer may still be incomplete
+    return response
+
+@app.cli.command("build-phrase-bank")
+def build_phrase_bank_command():
+    """Synthesize the phrase bank with the current voice and save the bundle."""
+    bank = build_phrase_bank()
+    save_phrase_bank(bank)
+    print(f"✅ Saved {len(bank)} phrases to {PHRASE_BANK_DIR}/")
+
+if TTS_WARM_UP:
+    threading.Thread(target=warm_up_tts, daemon=True).start()
+
+if PHRASE_BANK_ON_START:
+    threading.Thread(target=load_phrase_bank, daemon=True).start()
+
+if AUDIO_STORE == "disk" and AUDIO_JANITOR_INTERVAL > 0:
+    threading.Thread(target=audio_janitor_loop, daemon=True).start()
+
+if semantic_cache is not None and SEMANTIC_CACHE_COMPACT_INTERVAL > 0:
+    threading.Thread(target=semantic_cache_compactor, daemon=True).start()
 
 if __name__ == "__main__":
     app.run(debug=True, port=5001)
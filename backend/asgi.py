@@ -0,0 +1,343 @@
+"""
+ASGI variant of the backend. /api/chat and /api/chat/stream run the same
+chat_turn pipeline as app.py, driven asynchronously: OpenAI through an async
+client (hedged when HEDGING is on), TTS through the backend's async
+synthesize, and the blocking Gmail/Calendar handlers and audio cache on a
+bounded thread pool, so a request waiting on upstream I/O does not hold a
+worker thread. Every other route is served by the Flask app in app.py.
+
+Run with:
+    hypercorn asgi:app --bind 127.0.0.1:5001
+"""
+import asyncio
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import openai
+from hypercorn.middleware import AsyncioWSGIMiddleware
+from quart import Quart, Response, jsonify, request
+
+import app as clark
+
+# Gmail/Calendar handlers and other blocking helpers run here
+BLOCKING_MAX_WORKERS = int(os.getenv("ASGI_BLOCKING_WORKERS", "32"))
+# Concurrent TTS requests across all sessions
+ASYNC_TTS_CONCURRENCY = int(os.getenv("ASGI_TTS_CONCURRENCY", "64"))
+
+blocking_executor = ThreadPoolExecutor(max_workers=BLOCKING_MAX_WORKERS, thread_name_prefix="asgi-blocking")
+tts_semaphore = None  # created on the event loop
+async_openai_client = None
+
+chat_app = Quart(__name__)
+
+async def run_blocking(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(blocking_executor, function, *args)
+
+def get_async_openai_client():
+    """
+    Returns the shared async OpenAI client, with the same pool, timeouts and
+    retry settings as the synchronous one in app.py.
+    """
+    global async_openai_client
+    if async_openai_client is None:
+        timeout = httpx.Timeout(clark.OPENAI_READ_TIMEOUT, connect=clark.OPENAI_CONNECT_TIMEOUT)
+        async_openai_client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            max_retries=0,  # Retried in openai_request instead
+            timeout=timeout,
+            http_client=httpx.AsyncClient(
+                timeout=timeout,
+                limits=httpx.Limits(
+                    max_connections=clark.OPENAI_POOL_SIZE,
+                    max_keepalive_connections=clark.OPENAI_KEEPALIVE_CONNECTIONS,
+                    keepalive_expiry=clark.OPENAI_KEEPALIVE_EXPIRY,
+                ),
+            ),
+        )
+    return async_openai_client
+
+async def release_when_done(stream):
+    try:
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.close()
+        clark.track_openai_request(-1)
+
+async def openai_request(call, stream=False):
+    """
+    Async counterpart of app.openai_request, with the same retry policy
+    (app.openai_retry_delay), retry budget and pool metrics.
+    """
+    client = get_async_openai_client()
+    clark.openai_retry_budget.deposit()
+    clark.track_openai_request(1)
+    attempt = 0
+    try:
+        while True:
+            try:
+                response = await call(client)
+                break
+            except Exception as e:
+                delay = clark.openai_retry_delay(e, attempt)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+    except asyncio.CancelledError:  # Lost a hedging race
+        clark.track_openai_request(-1)
+        raise
+    except Exception:
+        clark.record_openai_failure()
+        raise
+
+    if stream:
+        return release_when_done(response)
+    clark.track_openai_request(-1)
+    return response
+
+async def create_chat_completion(**kwargs):
+    return await openai_request(lambda client: client.chat.completions.create(**kwargs), stream=kwargs.get("stream", False))
+
+async def start_stream(kwargs, record_latency):
+    """
+    Opens a streamed completion and waits for its first chunk. Returns
+    (stream, first_chunk).
+    """
+    started = time.monotonic()
+    stream = await create_chat_completion(**kwargs)
+    try:
+        chunk = await anext(stream, None)
+    except BaseException:
+        await stream.aclose()
+        raise
+    if record_latency:
+        with clark.hedge_lock:
+            clark.hedge_latencies.append(time.monotonic() - started)
+    return stream, chunk
+
+async def relay_stream(stream, first_chunk):
+    try:
+        if first_chunk is not None:
+            yield first_chunk
+        async for chunk in stream:
+            yield chunk
+    finally:
+        await stream.aclose()
+
+async def hedged_stream(kwargs):
+    """
+    Async counterpart of app.hedged_stream, sharing its delay, budget and
+    metrics. The first request to start streaming wins; the other one is
+    cancelled, which closes its stream.
+    """
+    clark.hedge_budget.deposit()
+    with clark.hedge_lock:
+        clark.hedge_metrics["requests"] += 1
+    primary = asyncio.ensure_future(start_stream(kwargs, True))
+    attempts = {primary}
+    backup = None
+
+    done, _ = await asyncio.wait(attempts, timeout=clark.hedge_delay())
+    if not done:
+        if clark.hedge_budget.withdraw():
+            backup_kwargs = dict(kwargs, model=clark.HEDGE_FALLBACK_MODEL) if clark.HEDGE_FALLBACK_MODEL else kwargs
+            backup = asyncio.ensure_future(start_stream(backup_kwargs, False))
+            attempts.add(backup)
+            with clark.hedge_lock:
+                clark.hedge_metrics["hedged"] += 1
+        else:
+            with clark.hedge_lock:
+                clark.hedge_metrics["budget_denied"] += 1
+
+    winner = None
+    error = None
+    pending = attempts
+    while pending and winner is None:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                error = error or task.exception()
+            elif winner is None:
+                winner = task
+            else:
+                await task.result()[0].aclose()
+
+    for task in pending:  # Losers still waiting for their first token
+        task.cancel()
+
+    if winner is None:
+        raise error
+    if winner is backup:
+        with clark.hedge_lock:
+            clark.hedge_metrics["backup_wins"] += 1
+    return relay_stream(*winner.result())
+
+async def chat_completion_stream(kwargs):
+    """
+    Streamed chat completion, hedged when HEDGING is on.
+    """
+    if clark.HEDGING:
+        return await hedged_stream(kwargs)
+    return await create_chat_completion(**kwargs)
+
+async def synthesize_speech(text, audio_format=clark.DEFAULT_AUDIO_FORMAT):
+    """
+    Async counterpart of app.synthesize_speech for the configured TTS backend.
+    """
+    global tts_semaphore
+    if tts_semaphore is None:
+        tts_semaphore = asyncio.Semaphore(ASYNC_TTS_CONCURRENCY)
+    async with tts_semaphore:
+        return await clark.tts_backend.synthesize_async(text, audio_format)
+
+async def synthesize_fragment(fragment, audio_format=clark.DEFAULT_AUDIO_FORMAT):
+    clip_id = clark.audio_clip_id(fragment, audio_format)
+    audio_content = await run_blocking(clark.read_cached_clip, clip_id)
+    if audio_content is not None:
+        clark.count_fragment("hits")
+        return audio_content
+
+    clark.count_fragment("misses")
+    audio_content = await synthesize_speech(fragment, audio_format)
+    await run_blocking(clark.store_clip, clip_id, audio_content)
+    return audio_content
+
+async def synthesize_for_reply(text, audio_format=clark.DEFAULT_AUDIO_FORMAT):
+    """
+    Same strategy as app.synthesize_for_reply, with fragments or chunks
+    synthesized concurrently on the event loop.
+    """
+    stitchable = clark.AUDIO_FORMATS[audio_format]["stitchable"]
+    if clark.TTS_FRAGMENT_CACHE and stitchable:
+        parts = clark.split_fragments(text)
+        synthesize = synthesize_fragment
+    elif clark.TTS_PARALLEL and stitchable and len(text) >= clark.TTS_PARALLEL_MIN_CHARS:
+        parts = clark.chunk_sentences(text)
+        synthesize = synthesize_speech
+    else:
+        return await synthesize_speech(text, audio_format)
+
+    if len(parts) <= 1:
+        return await synthesize(text, audio_format)
+    audio = await asyncio.gather(*(synthesize(part, audio_format) for part in parts))
+    return clark.stitch_mp3(audio)  # gather keeps input order
+
+async def speak_response(text, audio_format=clark.DEFAULT_AUDIO_FORMAT):
+    text = clark.normalize_tts_text(text)
+    if audio_format == clark.DEFAULT_AUDIO_FORMAT and text in clark.phrase_bank_index:
+        return clark.phrase_bank_index[text]  # Pre-synthesized, no TTS call
+
+    filename = clark.audio_clip_id(text, audio_format)
+    if await run_blocking(clark.clip_is_cached, filename):
+        print(f"✅ Audio cache hit: {filename}")  # Debugging
+        return filename
+
+    audio_content = await synthesize_for_reply(text, audio_format)
+    await run_blocking(clark.store_clip, filename, audio_content)
+    print(f"✅ Audio clip generated ({clark.AUDIO_STORE}): {filename}")  # Debugging
+    return filename
+
+async def render_audio(text, audio_mode="file", audio_format=clark.DEFAULT_AUDIO_FORMAT):
+    """
+    Async counterpart of app.render_audio. Streams and tickets only hand work
+    to app.py's TTS pools and return at once, so they are reused as is.
+    """
+    if audio_mode == "none":
+        return None
+    stitchable = clark.AUDIO_FORMATS[audio_format]["stitchable"]
+    if audio_mode in ("deferred", "lazy") or (audio_mode == "stream" and stitchable):
+        return await run_blocking(clark.render_audio, text, audio_mode, audio_format)
+    return await speak_response(text, audio_format)
+
+async def run_chat_turn(turn):
+    """
+    Async counterpart of app.run_chat_turn: blocking calls go to the thread
+    pool, completions and audio are awaited on the event loop.
+    """
+    result, error = None, None
+    try:
+        while True:
+            try:
+                step = turn.throw(error) if error is not None else turn.send(result)
+            except StopIteration:
+                return
+            result, error = None, None
+            try:
+                if step[0] == "event":
+                    yield step[1], step[2]
+                elif step[0] == "call":
+                    result = await run_blocking(*step[1:])
+                elif step[0] == "completion":
+                    result = await chat_completion_stream(step[1])
+                elif step[0] == "chunk":
+                    result = await anext(step[1], None)
+                elif step[0] == "audio":
+                    result = await render_audio(*step[1:])
+            except Exception as e:
+                error = e
+    finally:
+        turn.close()
+
+@chat_app.after_request
+async def add_cors_headers(response):
+    # Same policy as flask_cors' defaults in app.py
+    response.headers["Access-Control-Allow-Origin"] = "*"
+    if request.method == "OPTIONS":
+        response.headers["Access-Control-Allow-Methods"] = "POST, OPTIONS"
+        response.headers["Access-Control-Allow-Headers"] = request.headers.get("Access-Control-Request-Headers", "*")
+    return response
+
+async def read_chat_request():
+    data = await request.get_json()
+    audio_format = clark.negotiate_audio_format(data.get("audio_format"), request.accept_mimetypes)
+    return data.get("message", ""), data.get("audio_mode", "file"), audio_format
+
+@chat_app.route("/api/chat", methods=["POST"])
+async def chat():
+    """
+    Async /api/chat: same request, response and caching behaviour as app.chat.
+    """
+    user_message, audio_mode, audio_format = await read_chat_request()
+
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+
+    async for event, payload in run_chat_turn(clark.chat_turn(user_message, audio_mode, audio_format)):
+        if event == "done":
+            return jsonify(payload)
+        if event == "error":
+            return jsonify(payload), 500
+
+@chat_app.route("/api/chat/stream", methods=["POST"])
+async def chat_stream():
+    """
+    Async /api/chat/stream: same Server-Sent Events as app.chat_stream.
+    """
+    user_message, audio_mode, audio_format = await read_chat_request()
+
+    if not user_message:
+        return jsonify({"error": "No message provided"}), 400
+
+    async def generate():
+        async for event, payload in run_chat_turn(clark.chat_turn(user_message, audio_mode, audio_format)):
+            yield clark.sse_event(event, payload)
+
+    response = Response(generate(), mimetype="text/event-stream")
+    response.headers["Cache-Control"] = "no-cache"
+    response.headers["X-Accel-Buffering"] = "no"  # Don't let nginx buffer the stream
+    return response
+
+ASYNC_ROUTES = {"/api/chat", "/api/chat/stream"}
+flask_app = AsyncioWSGIMiddleware(clark.app)
+
+async def app(scope, receive, send):
+    """
+    ASGI entry point: the chat routes (and lifespan events) go to the async
+    app, everything else to the Flask app.
+    """
+    if scope["type"] == "lifespan" or scope.get("path") in ASYNC_ROUTES:
+        return await chat_app(scope, receive, send)
+    return await flask_app(scope, receive, send)
@@ -0,0 +1,11 @@
+import os
+import sys
+
+# Keep importing app.py cheap: no TTS warm-up, phrase bank or background janitor.
+os.environ.setdefault("TTS_WARM_UP", "0")
+os.environ.setdefault("PHRASE_BANK_ON_START", "0")
+os.environ.setdefault("AUDIO_JANITOR_INTERVAL", "0")
+os.environ.setdefault("AUDIO_STORE", "memory")
+os.environ.setdefault("CONVERSATION_MEMORY", "0")
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
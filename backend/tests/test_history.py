@@ -0,0 +1,45 @@
+import pytest
+
+import app
+
+
+@pytest.fixture(autouse=True)
+def history(monkeypatch):
+    monkeypatch.setattr(app, "count_tokens", lambda model, text: len(text) // 4 + 1)
+    monkeypatch.setattr(app, "CONVERSATION_MEMORY", False)
+    monkeypatch.setattr(app, "conversation_history", [])
+    return app.conversation_history
+
+
+def fill(history, messages, tokens):
+    for i in range(messages):
+        role = "user" if i % 2 == 0 else "assistant"
+        history.append({"role": role, "content": "x" * ((tokens - app.MESSAGE_TOKEN_OVERHEAD - 1) * 4)})
+
+
+def total_tokens(model, messages):
+    return sum(app.message_tokens(model, message) for message in messages)
+
+
+def test_small_route_turn_keeps_the_shared_window(history):
+    fill(history, 30, 255)  # 7650 tokens: over the small budget, under the large one
+    small = app.MODEL_ROUTES["small"]["model"]
+    large = app.MODEL_ROUTES["large"]["model"]
+
+    snapshot = app.start_turn("hi", small)
+    assert len(history) == 31
+    assert total_tokens(small, snapshot + history[-1:]) <= app.HISTORY_TOKEN_BUDGETS[small]
+    assert snapshot == history[len(history) - 1 - len(snapshot):-1]
+
+    app.end_turn("Hello!")
+    snapshot = app.start_turn("Explain how the plan works", large)
+    assert len(history) == 33
+    assert snapshot == history[:-1]
+
+
+def test_shared_window_is_trimmed_to_the_largest_budget(history):
+    fill(history, 40, 255)
+    evicted = app.trim_history()
+    budget = app.HISTORY_TOKEN_BUDGETS[app.HISTORY_WINDOW_MODEL]
+    assert evicted
+    assert total_tokens(app.HISTORY_WINDOW_MODEL, history) <= budget * app.HISTORY_TRIM_RATIO
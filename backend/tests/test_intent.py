@@ -0,0 +1,25 @@
+import pytest
+
+import app
+
+EMAIL = ("handle_email_action", {"action": "read_emails"}, "rules")
+CALENDAR = ("handle_calendar_action", {"action": "check_schedule"}, "rules")
+
+
+@pytest.mark.parametrize("message, expected", [
+    ("Read my emails", EMAIL),
+    ("Can you check my inbox, please?", EMAIL),
+    ("Any new mail?", EMAIL),
+    ("Do I have any unread emails today", EMAIL),
+    ("What's on my calendar today?", CALENDAR),
+    ("Do I have any meetings now", CALENDAR),
+    ("What events do I have coming up?", CALENDAR),
+    ("Check the mail server logs", None),
+    ("Check my email settings", None),
+    ("List the mail merge options", None),
+    ("Do I have any meetings with Bob next week?", None),
+    ("Send an email to Jane", None),
+    ("Read my emails and my calendar", None),
+])
+def test_classify_intent(message, expected):
+    assert app.classify_intent(message) == expected
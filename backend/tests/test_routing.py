@@ -0,0 +1,22 @@
+import pytest
+
+import app
+
+
+@pytest.mark.parametrize("message, route", [
+    ("hi", "small"),
+    ("How are you?", "small"),
+    ("Why not", "small"),
+    ("What's the plan?", "small"),
+    ("Thanks, that's great", "small"),
+    ("How do I reverse a list in Python?", "large"),
+    ("How to cook rice", "large"),
+    ("Why is the sky blue?", "large"),
+    ("Help me plan a trip to Lisbon", "large"),
+    ("Explain recursion", "large"),
+    ("What's on my calendar?", "large"),
+    ("Tell me a really long story about a dragon who lived in a castle by the sea and loved to read books", "large"),
+])
+def test_choose_route(monkeypatch, message, route):
+    monkeypatch.setattr(app, "MODEL_ROUTING", True)
+    assert app.choose_route(message) == route
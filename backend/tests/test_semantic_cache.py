@@ -0,0 +1,48 @@
+import time
+
+import pytest
+
+np = pytest.importorskip("numpy")
+
+import app
+
+
+def unit(*values):
+    vector = np.array(values, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def test_search_only_matches_the_same_context():
+    cache = app.SemanticCache(3, 100, 60, 0.9)
+    cache.add(unit(1, 0, 0), 1, "first")
+    cache.add(unit(0, 1, 0), 2, "second")
+
+    assert cache.search(unit(1, 0.1, 0), 1) == "first"
+    assert cache.search(unit(1, 0.1, 0), 2) is None
+    assert cache.search(unit(0, 0, 1), 1) is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+def test_full_cache_evicts_least_recently_written_contexts():
+    cache = app.SemanticCache(3, 10, 60, 0.9)
+    for context_id in range(9):
+        cache.add(unit(1, 0, 0), context_id, context_id)
+    cache.add(unit(0, 1, 0), 0, "newer")  # Context 0 becomes the most recently written
+    cache.add(unit(1, 0, 0), 10, 10)  # Full: context 1 is the oldest
+
+    assert cache.search(unit(1, 0, 0), 1) is None
+    assert cache.search(unit(1, 0, 0), 0) == 0
+    assert cache.search(unit(1, 0, 0), 10) == 10
+
+
+def test_compact_drops_expired_rows():
+    cache = app.SemanticCache(3, 100, 0.01, 0.9)
+    for i in range(6):
+        cache.add(unit(1, i, 0), 1, i)
+    time.sleep(0.02)
+    cache.add(unit(0, 0, 1), 2, "fresh")
+    cache.compact()
+
+    assert cache._size == 1
+    assert cache.search(unit(1, 0, 0), 1) is None
+    assert cache.search(unit(0, 0, 1), 2) == "fresh"
@@ -0,0 +1,57 @@
+import time
+from datetime import datetime, timezone
+
+import pytest
+
+import app
+
+NOW = datetime(2025, 3, 4, 12, 0, tzinfo=timezone.utc)  # A Tuesday
+
+
+@pytest.fixture(autouse=True)
+def utc_local_time(monkeypatch):
+    monkeypatch.setenv("TZ", "UTC")
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("Tue, 04 Mar 2025 15:30:00 +0000", "today at 3:30 PM"),
+    ("Thu, 06 Mar 2025 09:00:00 GMT", "on Thursday at 9 AM"),
+    ("Mon, 03 Mar 2025 18:00:00 UTC", "yesterday at 6 PM"),
+    ("Wed, 05 Mar 2025 01:00:00 -0800", "tomorrow at 9 AM"),
+    ("Sat, 01 Feb 2025 10:15:00 +0000", "on February 1 at 10:15 AM"),
+    ("2025-03-05T09:00:00Z", "tomorrow at 9 AM"),
+    ("2025-03-07T14:00:00+00:00", "on Friday at 2 PM"),
+    ("2025-03-05", "tomorrow"),
+    ("Unknown date", None),
+])
+def test_humanize_date(value, expected):
+    assert app.humanize_date(value, now=NOW) == expected
+
+
+def test_email_snippet_is_unescaped_and_trimmed():
+    emails = [{
+        "sender": "Jane Doe <jane@example.com>",
+        "subject": "**Lunch** plans",
+        "date": "Unknown date",
+        "snippet": "Let&#39;s meet at Joe&amp;Co. " + "word " * 40,
+    }]
+    spoken = app.format_emails_for_voice(emails)
+    assert spoken.startswith("You have one recent email. First, from Jane Doe: Lunch plans. It says: Let's meet at Joe&Co.")
+    assert spoken.endswith("word...")
+    assert len(spoken.split("It says: ")[1]) <= app.EMAIL_SNIPPET_CHARS + 3
+
+
+@pytest.mark.parametrize("text, expected", [
+    ("**Bold** and _italic_ and `code`", "Bold and italic and code"),
+    ("***Both*** and **_nested_**", "Both and nested"),
+    ("Open file_name_here.py", "Open file_name_here.py"),
+    ("2*3*4 is 24", "2*3*4 is 24"),
+    ("- first item\n# Heading", "first item Heading"),
+    ("See [the docs](https://example.com)", "See the docs"),
+])
+def test_strip_markdown(text, expected):
+    assert app.strip_markdown(text) == expected
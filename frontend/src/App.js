@@ -235,6 +235,7 @@ function App() {
       const res = await axios.post("http://127.0.0.1:5001/api/chat", {
         message: finalMessage,
         history,
+        audio_mode: "stream", // start playback while later sentences are synthesized
       });
       setResponse(res.data.response);
       setHistory(res.data.history);